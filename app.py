@@ -2,14 +2,46 @@ from flask import Flask, request, Response
 from dotenv import load_dotenv
 from os import environ
 import json
+import logging
+
+# before the src imports, some of their settings are read at import time
+load_dotenv()
 
 from src.controllers.areas import AreaProcessor
-from src.controllers.positions import CoordsProcesor
-from src.modules.compute import Compute
+from src.controllers.positions import SMOOTHING_METHODS, SOLVERS, CoordsProcesor
+from src.modules.cache import areas_cache, gateways_cache
+from src.modules.history import JobHistory
+from src.modules.jobs import JobQueue, QueueFull
+from src.modules.leases import JobLeases
+from src.modules.metrics import registry
+from src.modules.mongo import get_client
+from src.modules.service import AsyncJobQueue
+from src.modules.watermark import Watermark
 
-load_dotenv()
+logging.basicConfig(
+    level=environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# the app's processes flush their metrics for whichever one gets scraped
+registry.start()
+# "threads" runs each job on a worker thread, "asyncio" schedules them on
+# one event loop with I/O and CPU stages on separate executors
+runners = {"threads": JobQueue, "asyncio": AsyncJobQueue}
+# JOB_WORKERS and JOB_QUEUE_SIZE bound the jobs of every gunicorn worker
+# together, through leases in Mongo
+JOB_WORKERS = int(environ.get("JOB_WORKERS", 2))
+JOB_QUEUE_SIZE = int(environ.get("JOB_QUEUE_SIZE", 16))
+jobs = runners[environ.get("JOB_RUNNER", "threads")](
+    workers=JOB_WORKERS,
+    size=JOB_QUEUE_SIZE,
+    history=int(environ.get("JOB_HISTORY", 1000)),
+    leases=JobLeases(JOB_WORKERS, JOB_QUEUE_SIZE),
+    # any worker answers /jobs, so job records are kept in Mongo
+    store=JobHistory(),
+)
 
 
 def add_cors_headers(response):
@@ -39,14 +71,33 @@ def home():
 @app.route("/clean_beacon_data", methods=["POST"])
 def trigger_process():
     try:
-        body = request.get_json()
-        timestamp = body["timestamp"]
-        thread_a = Compute(request.__copy__(), class_name=CoordsProcesor, params={"timestamp": timestamp})
-        thread_a.start()
-        output = {"status": "success", "message": "process triggered"}
+        # without a timestamp the run continues from the stored watermark
+        body = request.get_json(silent=True) or {}
+        params = {
+            "timestamp": body.get("timestamp"),
+            "solver": body.get("solver"),
+            "workers": body.get("workers"),
+            "pipeline": body.get("pipeline"),
+            "smoothing": body.get("smoothing"),
+        }
+        if params["solver"] is not None and params["solver"] not in SOLVERS:
+            raise ValueError(f"unknown solver {params['solver']}")
+        if params["smoothing"] is not None and params["smoothing"] not in SMOOTHING_METHODS:
+            raise ValueError(f"unknown smoothing {params['smoothing']}")
+        # a malformed timestamp, or none before the first run, fails here
+        # rather than in the job
+        Watermark(get_client(), "positions").resolve(params["timestamp"])
+        job_id = jobs.submit(CoordsProcesor, params, profile=bool(body.get("profile")))
+        output = {"status": "success", "message": "process triggered", "job": job_id}
         status = 200
+    except QueueFull:
+        status = 429
+        output = {"status": "error", "message": "too many pending processes"}
+    except ValueError as e:
+        status = 400
+        output = {"status": "error", "message": str(e)}
     except Exception as e:
-        print(e)
+        log.exception(e)
         status = 500
         output = {"status": "error", "message": "process not triggered"}
     return Response(
@@ -57,10 +108,19 @@ def trigger_process():
 @app.route("/areas", methods=["POST"])
 def trigger_areas_process():
     try:
-        thread_a = Compute(request.__copy__(), class_name=AreaProcessor)
-        thread_a.start()
-        output = {"status": "success", "message": "process triggered"}
+        body = request.get_json(silent=True) or {}
+        Watermark(get_client(), "areas").resolve(body.get("timestamp"))
+        job_id = jobs.submit(
+            AreaProcessor, {"timestamp": body.get("timestamp")}, profile=bool(body.get("profile"))
+        )
+        output = {"status": "success", "message": "process triggered", "job": job_id}
         status = 200
+    except QueueFull:
+        output = {"status": "error", "message": "too many pending processes"}
+        status = 429
+    except ValueError as e:
+        output = {"status": "error", "message": str(e)}
+        status = 400
     except:
         output = {"status": "error", "message": "process not triggered"}
         status = 500
@@ -69,5 +129,51 @@ def trigger_areas_process():
     )
 
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    record = jobs.find(job_id)
+    if record is None:
+        output = {"status": "error", "message": "job not found"}
+        status = 404
+    else:
+        record.pop("profile_report", None)
+        output = {"status": "success", "job": record}
+        status = 200
+    return Response(
+        response=json.dumps(output), status=status, mimetype="application/json"
+    )
+
+
+@app.route("/jobs/<job_id>/profile", methods=["GET"])
+def job_profile(job_id):
+    # cProfile report of a job submitted with "profile": true
+    record = jobs.find(job_id)
+    if record is None or record.get("profile_report") is None:
+        output = {"status": "error", "message": "profile not found"}
+        return Response(
+            response=json.dumps(output), status=404, mimetype="application/json"
+        )
+    return Response(response=record["profile_report"], status=200, mimetype="text/plain")
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(
+        response=registry.render(), status=200, mimetype="text/plain; version=0.0.4"
+    )
+
+
+@app.route("/cache", methods=["GET"])
+def cache_status():
+    output = {
+        "status": "success",
+        "gateways": gateways_cache.to_dict(),
+        "areas": areas_cache.to_dict(),
+    }
+    return Response(
+        response=json.dumps(output), status=200, mimetype="application/json"
+    )
+
+
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=3001)
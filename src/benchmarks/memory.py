@@ -0,0 +1,183 @@
+from itertools import count
+from operator import itemgetter
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+
+class MemoryResult:
+    def __init__(self, upserted_count=0, modified_count=0):
+        self.upserted_count = upserted_count
+        self.modified_count = modified_count
+
+
+class MemoryCursor:
+    def __init__(self, documents, projection=None):
+        self.documents = documents
+        self.projection = projection
+
+    def sort(self, key, direction=None):
+        keys = key if direction is None else [(key, direction)]
+        # stable sorts from the last key to the first give the compound order
+        for field, way in reversed(list(keys)):
+            self.documents.sort(key=itemgetter(field), reverse=way < 0)
+        return self
+
+    def project(self, document):
+        if not self.projection:
+            return dict(document)
+        included = [field for field, value in self.projection.items() if value and field != "_id"]
+        if len(included) > 0:
+            output = {field: document[field] for field in included if field in document}
+            if self.projection.get("_id", 1) and "_id" in document:
+                output["_id"] = document["_id"]
+        else:
+            excluded = [field for field, value in self.projection.items() if not value]
+            output = {field: value for field, value in document.items() if field not in excluded}
+        return output
+
+    def __iter__(self):
+        for document in self.documents:
+            yield self.project(document)
+
+
+class MemoryCollection:
+    # The slice of pymongo's Collection the processors use: find (filter,
+    # projection, sort), find_one, update_one, bulk_write with UpdateOne and
+    # ReplaceOne upserts, create_index, index_information, insert_many and
+    # count_documents. Equality lookups on a created index are hashed, everything else scans
+    def __init__(self):
+        self.documents = dict()
+        self.ids = count()
+        self.indexes = dict()
+        self.index_keys = dict()
+
+    def matches(self, document, query):
+        for field, condition in (query or {}).items():
+            value = document.get(field)
+            if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+                for operator, operand in condition.items():
+                    if operator == "$gte" and not (value is not None and value >= operand):
+                        return False
+                    if operator == "$gt" and not (value is not None and value > operand):
+                        return False
+                    if operator == "$lte" and not (value is not None and value <= operand):
+                        return False
+                    if operator == "$lt" and not (value is not None and value < operand):
+                        return False
+                    if operator == "$ne" and value == operand:
+                        return False
+                    if operator == "$in" and value not in operand:
+                        return False
+            elif value != condition:
+                return False
+        return True
+
+    def index_key(self, fields, document):
+        return tuple(document.get(field) for field in fields)
+
+    def lookup(self, query):
+        query = query or {}
+        if "_id" in query and not isinstance(query["_id"], dict):
+            document = self.documents.get(query["_id"])
+            return [document] if document is not None and self.matches(document, query) else []
+        fields = tuple(sorted(query))
+        if fields in self.indexes and all(not isinstance(value, dict) for value in query.values()):
+            document_id = self.indexes[fields].get(self.index_key(fields, query))
+            return [self.documents[document_id]] if document_id is not None else []
+        return [document for document in self.documents.values() if self.matches(document, query)]
+
+    def store(self, document):
+        previous = self.documents.get(document["_id"])
+        for fields, index in self.indexes.items():
+            if previous is not None:
+                index.pop(self.index_key(fields, previous), None)
+            index[self.index_key(fields, document)] = document["_id"]
+        self.documents[document["_id"]] = document
+
+    def create_index(self, keys, **kwargs):
+        fields = tuple(sorted(field for field, _ in keys))
+        if fields not in self.indexes:
+            self.indexes[fields] = {
+                self.index_key(fields, document): document["_id"] for document in self.documents.values()
+            }
+        name = "_".join(f"{field}_{direction}" for field, direction in keys)
+        self.index_keys[name] = dict(kwargs, key=list(keys))
+        return name
+
+    def index_information(self):
+        return dict(self.index_keys)
+
+    def insert_many(self, documents):
+        for document in documents:
+            document = dict(document)
+            document.setdefault("_id", next(self.ids))
+            self.store(document)
+
+    def find(self, filter=None, projection=None, sort=None, batch_size=None):
+        cursor = MemoryCursor(self.lookup(filter), projection)
+        if sort is not None:
+            cursor.sort(sort)
+        return cursor
+
+    def find_one(self, filter=None):
+        for document in self.find(filter):
+            return document
+        return None
+
+    def count_documents(self, filter):
+        return len(self.lookup(filter))
+
+    def apply(self, document, update):
+        document = dict(document)
+        for field, value in update.get("$set", {}).items():
+            document[field] = value
+        for field, value in update.get("$max", {}).items():
+            if document.get(field) is None or value > document[field]:
+                document[field] = value
+        return document
+
+    def write(self, query, update, upsert, replace=False):
+        found = self.lookup(query)
+        if len(found) == 0:
+            if not upsert:
+                return MemoryResult()
+            base = {field: value for field, value in query.items() if not isinstance(value, dict)}
+            document = dict(base, **update) if replace else self.apply(base, update)
+            if document.get("_id") in self.documents:
+                # an upsert whose filter missed an existing _id
+                raise DuplicateKeyError(f"duplicate _id {document['_id']!r}")
+            document.setdefault("_id", next(self.ids))
+            self.store(document)
+            return MemoryResult(upserted_count=1)
+        current = found[0]
+        document = dict(update, _id=current["_id"]) if replace else self.apply(current, update)
+        self.store(document)
+        return MemoryResult(modified_count=1)
+
+    def update_one(self, filter, update, upsert=False):
+        return self.write(filter, update, upsert)
+
+    def bulk_write(self, operations, ordered=True):
+        upserted = modified = 0
+        for operation in operations:
+            # pymongo's request objects keep their arguments in slots
+            replace = isinstance(operation, ReplaceOne)
+            if not replace and not isinstance(operation, UpdateOne):
+                raise TypeError(f"unsupported bulk operation {operation!r}")
+            result = self.write(operation._filter, operation._doc, operation._upsert, replace=replace)
+            upserted += result.upserted_count
+            modified += result.modified_count
+        return MemoryResult(upserted, modified)
+
+
+class MemoryDatabase(dict):
+    def __missing__(self, name):
+        collection = self[name] = MemoryCollection()
+        return collection
+
+
+class MemoryClient(dict):
+    # stands in for a MongoClient in benchmarks, client["beacons"][...]
+    def __missing__(self, name):
+        database = self[name] = MemoryDatabase()
+        return database
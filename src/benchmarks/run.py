@@ -0,0 +1,138 @@
+from datetime import datetime, timedelta
+from time import perf_counter, sleep
+import argparse
+import json
+import logging
+import numpy
+import pandas as pd
+import platform
+import subprocess
+
+from src.benchmarks.memory import MemoryClient
+from src.benchmarks.synthetic import SyntheticData
+from src.controllers.areas import AreaProcessor
+from src.controllers.positions import CoordsProcesor
+from src.modules.cache import areas_cache, gateways_cache
+from src.modules.spatial import raster_cache
+from src.modules.stats import Stats
+
+# Times every stage of a full run (read, prefetch, trilateration, insert,
+# area assignment, clean, post) over seeded synthetic data, with Mongo
+# replaced by an in-memory collection and the main API by the generator.
+#
+#   python -m src.benchmarks.run --beacons 200 --minutes 30 --out bench.json
+
+
+def bench_classes(data, post_latency):
+    class BenchAreaProcessor(AreaProcessor):
+        def fetch_areas(self, mac_address):
+            return data.fetch_areas(mac_address)
+
+        def post_positions(self, rows):
+            sleep(post_latency)
+            return {"sent": len(rows), "failed": 0}
+
+    class BenchCoordsProcesor(CoordsProcesor):
+        areas_class = BenchAreaProcessor
+
+        def fetch_gateways(self, mac_address):
+            return data.fetch_gateways(mac_address)
+
+    return BenchCoordsProcesor
+
+
+def revision():
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+        return output.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_once(args, readings, data):
+    client = MemoryClient()
+    client["beacons"]["raw_beacons_data"].insert_many(readings)
+    if not args.warm:
+        gateways_cache.clear()
+        areas_cache.clear()
+        raster_cache.clear()
+    stats = Stats()
+    processor_class = bench_classes(data, args.post_latency)
+    params = {
+        "timestamp": str(data.start - timedelta(seconds=1)),
+        "solver": args.solver,
+        "workers": args.workers,
+        "pipeline": args.pipeline,
+        "smoothing": args.smoothing,
+        "stats": stats,
+    }
+    start = perf_counter()
+    processor_class(params, client=client).main()
+    seconds = perf_counter() - start
+    return {
+        "seconds": round(seconds, 6),
+        "readings_per_second": round(len(readings) / seconds, 1),
+        "positions": client["beacons"]["beacons_data"].count_documents({}),
+        "stages": stats.to_dict(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the positions pipeline on synthetic data")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--facilities", type=int, default=1)
+    parser.add_argument("--beacons", type=int, default=50, help="beacons per facility")
+    parser.add_argument("--gateways", type=int, default=9, help="gateways per facility")
+    parser.add_argument("--areas", type=int, default=6, help="areas per facility")
+    parser.add_argument("--minutes", type=float, default=10)
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between readings")
+    parser.add_argument("--noise", type=float, default=0.5, help="std of the distance noise in meters")
+    parser.add_argument("--solver", default="trilateration")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--pipeline", action="store_true")
+    parser.add_argument("--smoothing", default="none", choices=["none", "ema", "kalman"])
+    parser.add_argument("--warm", action="store_true", help="keep topology caches between repeats")
+    parser.add_argument("--post-latency", type=float, default=0.0, help="seconds each post takes")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--log-level", default="WARNING", help="log level of the processors")
+    parser.add_argument("--out", help="JSON file for the results, stdout if missing")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper())
+
+    start = perf_counter()
+    data = SyntheticData(
+        seed=args.seed,
+        facilities=args.facilities,
+        beacons=args.beacons,
+        gateways=args.gateways,
+        areas=args.areas,
+        minutes=args.minutes,
+        interval=args.interval,
+        noise=args.noise,
+    )
+    readings = data.readings()
+    generated = perf_counter() - start
+
+    runs = [run_once(args, readings, data) for _ in range(args.repeat)]
+    output = {
+        "revision": revision(),
+        "created_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "pandas": pd.__version__,
+        "params": vars(args),
+        "readings": len(readings),
+        "generate_seconds": round(generated, 6),
+        "best": min(runs, key=lambda run: run["seconds"]),
+        "runs": runs,
+    }
+    if args.out:
+        with open(args.out, "w") as file:
+            json.dump(output, file, indent=2)
+        print(f"{len(readings)} readings, best run {output['best']['seconds']} s, saved to {args.out}")
+    else:
+        print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main()
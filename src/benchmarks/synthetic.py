@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta
+import numpy
+
+
+class SyntheticFacility:
+    # A rectangular floor split in a grid of rooms (the areas), gateways on
+    # a jittered grid and beacons that dwell in a room for a while before
+    # walking to another one
+    def __init__(self, rng, number, beacons=50, gateways=9, areas=6, width=40.0, height=30.0):
+        self.number = number
+        self.width = width
+        self.height = height
+        self.beacons = [f"fc:{number:02x}:00:00:{beacon // 256:02x}:{beacon % 256:02x}" for beacon in range(beacons)]
+        self.gateways = self.make_gateways(rng, gateways)
+        self.areas = self.make_areas(rng, areas)
+
+    def make_gateways(self, rng, amount):
+        columns = int(numpy.ceil(numpy.sqrt(amount * self.width / self.height)))
+        rows = int(numpy.ceil(amount / columns))
+        gateways = dict()
+        for gateway in range(amount):
+            row, column = divmod(gateway, columns)
+            x = (column + 0.5 + rng.uniform(-0.3, 0.3)) * self.width / columns
+            y = (row + 0.5 + rng.uniform(-0.3, 0.3)) * self.height / rows
+            mac_address = f"ac:{self.number:02x}:00:00:00:{gateway:02x}"
+            gateways[mac_address] = {"x": round(float(x), 2), "y": round(float(y), 2)}
+        return gateways
+
+    def make_areas(self, rng, amount):
+        columns = int(numpy.ceil(numpy.sqrt(amount * self.width / self.height)))
+        rows = int(numpy.ceil(amount / columns))
+        room_width = self.width / columns
+        room_height = self.height / rows
+        areas = []
+        for area in range(amount):
+            row, column = divmod(area, columns)
+            # rooms are quadrilaterals a little inside their grid cell, so
+            # there are corridors between them where no area matches
+            corners = [(0, 0), (1, 0), (1, 1), (0, 1)]
+            vertices = []
+            for corner_x, corner_y in corners:
+                inset_x = rng.uniform(0.02, 0.08) * (1 if corner_x == 0 else -1)
+                inset_y = rng.uniform(0.02, 0.08) * (1 if corner_y == 0 else -1)
+                x = (column + corner_x + inset_x) * room_width
+                y = (row + corner_y + inset_y) * room_height
+                vertices.append([round(float(x), 2), round(float(y), 2)])
+            areas.append({"idArea": self.number * 1000 + area + 1, "vertices": vertices})
+        return areas
+
+    def gateways_response(self, mac_address):
+        # what fetch_gateways returns for any beacon of the facility
+        return dict(self.gateways), list(self.beacons)
+
+    def areas_response(self, mac_address):
+        return [dict(area) for area in self.areas], list(self.beacons)
+
+
+class SyntheticData:
+    # Seeded facilities and raw_beacons_data readings. Every interval
+    # seconds each beacon is heard by the gateways within reach (at least
+    # three), with gaussian noise on the distances, a share of outliers and
+    # a share of readings without meters
+    def __init__(
+        self,
+        seed=0,
+        facilities=1,
+        beacons=50,
+        gateways=9,
+        areas=6,
+        minutes=10,
+        interval=2.0,
+        noise=0.5,
+        outliers=0.01,
+        missing=0.01,
+        reach=25.0,
+        start=datetime(2021, 11, 22, 22, 0, 0),
+    ):
+        self.seed = seed
+        self.rng = numpy.random.default_rng(seed)
+        self.minutes = minutes
+        self.interval = interval
+        self.noise = noise
+        self.outliers = outliers
+        self.missing = missing
+        self.reach = reach
+        self.start = start
+        self.facilities = [
+            SyntheticFacility(self.rng, number, beacons, gateways, areas) for number in range(facilities)
+        ]
+        self.beacon_facility = {
+            beacon: facility for facility in self.facilities for beacon in facility.beacons
+        }
+
+    def walk(self, facility, steps):
+        # positions of one beacon: dwell in a room, then head to the next one
+        positions = numpy.empty((steps, 2))
+        area = facility.areas[self.rng.integers(len(facility.areas))]
+        position = numpy.mean(area["vertices"], axis=0)
+        target = position
+        for step in range(steps):
+            if numpy.linalg.norm(target - position) < 0.5 and self.rng.random() < 0.05:
+                area = facility.areas[self.rng.integers(len(facility.areas))]
+                target = numpy.mean(area["vertices"], axis=0) + self.rng.normal(0, 1.0, 2)
+            heading = target - position
+            distance = numpy.linalg.norm(heading)
+            if distance > 0:
+                position = position + heading / distance * min(distance, 1.2 * self.interval)
+            positions[step] = position + self.rng.normal(0, 0.2, 2)
+        return positions
+
+    def readings(self):
+        steps = int(self.minutes * 60 / self.interval)
+        rows = []
+        for facility in self.facilities:
+            macs = list(facility.gateways)
+            gateway_positions = numpy.array([[gateway["x"], gateway["y"]] for gateway in facility.gateways.values()])
+            for beacon in facility.beacons:
+                positions = self.walk(facility, steps)
+                offset = self.rng.uniform(0, self.interval)
+                for step, position in enumerate(positions):
+                    milliseconds = int((offset + step * self.interval) * 1000)
+                    created_at = self.start + timedelta(milliseconds=milliseconds)
+                    distances = numpy.linalg.norm(gateway_positions - position, axis=1)
+                    heard = numpy.flatnonzero(distances <= self.reach)
+                    if len(heard) < 3:
+                        heard = numpy.argsort(distances)[:3]
+                    meters = numpy.abs(distances[heard] + self.rng.normal(0, self.noise, len(heard)))
+                    wild = self.rng.random(len(heard)) < self.outliers
+                    meters[wild] = meters[wild] * self.rng.uniform(2, 5, wild.sum())
+                    lost = self.rng.random(len(heard)) < self.missing
+                    for gateway, value, empty in zip(heard.tolist(), meters.tolist(), lost.tolist()):
+                        rows.append(
+                            {
+                                "mac_address": beacon,
+                                "gateway": macs[gateway],
+                                "meters": None if empty else round(value, 6),
+                                "created_at": created_at,
+                            }
+                        )
+        return rows
+
+    def fetch_gateways(self, mac_address):
+        return self.beacon_facility[mac_address].gateways_response(mac_address)
+
+    def fetch_areas(self, mac_address):
+        return self.beacon_facility[mac_address].areas_response(mac_address)
@@ -1,22 +1,51 @@
-from pymongo import MongoClient
+import asyncio
+import logging
+import numpy
 import pandas as pd
 from datetime import datetime
-import requests
 import pandas as pd
 import os
 
+from src.modules.api import PositionsClient, get_session
+from src.modules.batches import POSITION_FIELDS, PositionBatch
+from src.modules.cache import TOPOLOGY_API_TIMEOUT, TOPOLOGY_PREFETCH_CONCURRENCY, areas_cache
+from src.modules.mongo import get_client
+from src.modules.sessions import SessionStore
+from src.modules.spatial import AreaIndex, AreaRaster, raster_cache
+from src.modules.stats import Stats
+from src.modules.watermark import Watermark
+
+log = logging.getLogger(__name__)
+
 MAIN_API_URL = os.getenv("MAIN_API_URL")
-MONGO_DB = os.getenv("MONGO_DB")
 MAIN_API_TOKEN = os.getenv("MAIN_API_TOKEN")
 
 
 class AreaProcessor:
-    def __init__(self, params):
+    def __init__(self, params, client=None):
         super(AreaProcessor, self).__init__()
         self.INT_MAX = 10000
-        self.timestamp = datetime.fromisoformat(params.get("timestamp"))
-        self.beacons_data = self.get_beacons_data()
-        self.areas_data = []
+        self.client = client if client is not None else get_client()
+        self.watermark = Watermark(self.client, "areas")
+        self.timestamp = self.watermark.resolve(params.get("timestamp"))
+        self.stats = params.get("stats") or Stats()
+        # "grid" tests every candidate area exactly, "raster" looks points
+        # up in a compiled label grid and only tests cells on area borders
+        self.area_lookup = params.get("area_lookup") or os.getenv("AREA_LOOKUP", "grid")
+        self.raster_resolution = float(os.getenv("AREA_RASTER_RESOLUTION", 0.25))
+        self.raster_max_cells = int(os.getenv("AREA_RASTER_MAX_CELLS", 4000000))
+        # with sessions on, dwell segments continue across runs instead of
+        # being cut at every run boundary
+        sessions = params.get("sessions", os.getenv("DWELL_SESSIONS", "false").lower() == "true")
+        self.sessions = SessionStore(self.client) if sessions else None
+        # read by main; a pipelined run hands positions to process_positions
+        # instead and never reads them back from Mongo
+        self.beacons_data = None
+
+    def read_beacons_data(self):
+        with self.stats.stage("read_data") as stage:
+            self.beacons_data = PositionBatch.from_records(self.get_beacons_data())
+            stage.rows_out = len(self.beacons_data)
 
     def get_orientation(self, p1, p2, p3):
 
@@ -122,42 +151,116 @@ class AreaProcessor:
         # Return true if count is odd, false otherwise
         return count % 2 == 1
 
+    def get_orientations(self, p1x, p1y, p2x, p2y, p3x, p3y):
+        # get_orientation over arrays, same arithmetic so ties (0) match exactly
+        dif = ((p2y - p1y) * (p3x - p2x)) - ((p2x - p1x) * (p3y - p2y))
+        return numpy.where(dif == 0, 0, numpy.where(dif > 0, 1, 2))
+
+    def are_on_segment(self, p1x, p1y, px, py, p2x, p2y):
+        return (
+            (px <= numpy.maximum(p1x, p2x))
+            & (px >= numpy.minimum(p1x, p2x))
+            & (py <= numpy.maximum(p1y, p2y))
+            & (py >= numpy.minimum(p1y, p2y))
+        )
+
+    def points_inside_polygons(self, vertices, counts, points):
+        # is_inside_area for K (polygon, point) pairs: vertices is (K, E, 2)
+        # padded to E vertices, counts the real vertex counts and points
+        # (K, 2). Edges are walked in order like the scalar loop: a point
+        # collinear with an edge its ray hits is decided on that edge
+        # (inside only if it lies on the segment), the rest use the parity
+        # of the crossings
+        inside = numpy.zeros(len(points), dtype=bool)
+        if len(points) == 0:
+            return inside
+
+        px, py = points[:, 0], points[:, 1]
+        ix, iy = float(self.INT_MAX), py
+        rows = numpy.arange(len(points))
+        decided = counts < 3
+        count = numpy.zeros(len(points), dtype=int)
+        for i in range(vertices.shape[1]):
+            edge = i < counts
+            following = numpy.where(i + 1 < counts, i + 1, 0)
+            p1x, p1y = vertices[:, i, 0], vertices[:, i, 1]
+            p2x, p2y = vertices[rows, following, 0], vertices[rows, following, 1]
+
+            # get_intersect(area[i], area[next], point, extreme)
+            o1 = self.get_orientations(p1x, p1y, p2x, p2y, px, py)
+            o2 = self.get_orientations(p1x, p1y, p2x, p2y, ix, iy)
+            o3 = self.get_orientations(px, py, ix, iy, p1x, p1y)
+            o4 = self.get_orientations(px, py, ix, iy, p2x, p2y)
+            intersect = (
+                ((o1 != o2) & (o3 != o4))
+                | ((o1 == 0) & self.are_on_segment(p1x, p1y, px, py, p2x, p2y))
+                | ((o2 == 0) & self.are_on_segment(p1x, p1y, ix, iy, p2x, p2y))
+                | ((o3 == 0) & self.are_on_segment(px, py, p1x, p1y, ix, iy))
+                | ((o4 == 0) & self.are_on_segment(px, py, p2x, p2y, ix, iy))
+            )
+
+            hit = intersect & edge & ~decided
+            collinear = hit & (self.get_orientations(p1x, p1y, px, py, p2x, p2y) == 0)
+            on_segment = self.are_on_segment(p1x, p1y, px, py, p2x, p2y)
+            inside[collinear] = on_segment[collinear]
+            decided |= collinear
+            count += hit & ~collinear
+
+        undecided = ~decided & (counts >= 3)
+        inside[undecided] = count[undecided] % 2 == 1
+        return inside
+
+    def points_inside_area(self, area, points):
+        # is_inside_area for an (N, 2) array of points and one polygon
+        points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+        vertices = numpy.asarray(area, dtype=float).reshape(-1, 2)
+        return self.points_inside_polygons(
+            numpy.broadcast_to(vertices, (len(points),) + vertices.shape),
+            numpy.full(len(points), len(vertices)),
+            points,
+        )
+
     def fetch_areas(self, mac_address):
         url = MAIN_API_URL + "/api/areas/beacon"
         headers = {"Authorization": f"Bearer {MAIN_API_TOKEN}"}
-        response = requests.get(
-            url, json={"macAddress": mac_address}, headers=headers
+        response = get_session().get(
+            url, json={"macAddress": mac_address}, headers=headers, timeout=TOPOLOGY_API_TIMEOUT
         ).json()
         data = response.get("data")
         beacons = [beacon.get("macAddress") for beacon in data.get("beacons")]
         gateways = data.get("areaVertices")
         return gateways, beacons
 
+    def load_facility(self, mac_address):
+        areas, beacons = self.fetch_areas(mac_address)
+        # the index is built once per facility fetch and cached with it
+        return AreaIndex(areas), beacons + [mac_address]
+
     def get_beacon_facility(self, mac_address):
         try:
-            if len(self.areas_data) > 0:
-                try:
-                    return next(
-                        data.get("gateways")
-                        for data in self.areas_data
-                        if mac_address in data.get("beacons")
-                    )
-                except StopIteration as e:
-                    pass
-            gateways, beacons = self.fetch_areas(mac_address)
-            self.areas_data.append({"gateways": gateways, "beacons": beacons})
-            return gateways
+            index = areas_cache.get(mac_address)
+            if index is None:
+                index, beacons = self.load_facility(mac_address)
+                areas_cache.put(beacons, index)
+            return index
         except Exception as e:
-            print("error", e)
-            return []
+            log.error("areas of %s not loaded: %s", mac_address, e)
+            return AreaIndex([])
+
+    def prefetch_facilities(self, mac_addresses):
+        with self.stats.stage("prefetch") as stage:
+            stage.rows_in = len(mac_addresses)
+            stage.rows_out = areas_cache.prefetch(
+                mac_addresses, self.load_facility, TOPOLOGY_PREFETCH_CONCURRENCY
+            )
 
     def process_beacons_data(self, beacon_data):
         point = [float(beacon_data.get("x")), float(beacon_data.get("y"))]
         mac_address = beacon_data.get("beacon")
-        areas = self.get_beacon_facility(mac_address)
+        index = self.get_beacon_facility(mac_address)
         area_id = next(
             area.get("idArea")
-            for area in areas
+            for area in index.candidates(point)
             if self.is_inside_area(area.get("vertices"), point)
         )
         try:
@@ -170,18 +273,74 @@ class AreaProcessor:
             }
             return output
         except Exception as e:
-            print("error", e)
+            log.error("position of %s not processed: %s", mac_address, e)
             return None
 
+    def to_floats(self, values):
+        try:
+            return numpy.array(values, dtype=float)
+        except (TypeError, ValueError):
+            return pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").to_numpy(dtype=float)
+
+    def assign_areas(self, data):
+        # Area of every position in data at once, None where no area of the
+        # beacon's facility contains it. Positions are grouped by facility,
+        # the facility's grid gives the (point, area) pairs to test and each
+        # point keeps its first matching area, as in process_beacons_data.
+        # data is a PositionBatch or a list of position dicts
+        if isinstance(data, PositionBatch):
+            points = data.points()
+            codes, beacons = data.beacons.codes, data.beacons.categories
+        else:
+            points = numpy.column_stack(
+                [self.to_floats([row.get("x") for row in data]), self.to_floats([row.get("y") for row in data])]
+            )
+            codes, beacons = pd.factorize(pd.Series([row.get("beacon") for row in data], dtype=object))
+        areas = numpy.full(len(data), None, dtype=object)
+        if len(data) == 0:
+            return points, areas
+
+        facilities = dict()
+        beacon_facility = numpy.zeros(len(beacons), dtype=int)
+        for code, mac_address in enumerate(beacons):
+            index = self.get_beacon_facility(mac_address)
+            facility = facilities.setdefault(id(index), (len(facilities), index))
+            beacon_facility[code] = facility[0]
+        point_facility = beacon_facility[codes]
+
+        for facility, index in facilities.values():
+            members = numpy.flatnonzero(point_facility == facility)
+            area_ids = numpy.array([area.get("idArea") for area in index.areas], dtype=object)
+            if self.area_lookup == "raster":
+                raster = raster_cache.get(
+                    index, self.points_inside_polygons, self.raster_resolution, self.raster_max_cells
+                )
+                labels = raster.lookup(points[members])
+                found = labels >= 0
+                areas[members[found]] = area_ids[labels[found]]
+                members = members[labels == AreaRaster.EXACT]
+            point_index, area_index = index.pairs(points[members])
+            inside = self.points_inside_polygons(
+                index.vertices[area_index], index.counts[area_index], points[members[point_index]]
+            )
+            # pairs are ordered by point then area, so the first inside pair
+            # of a point is its first matching area
+            matched, first = numpy.unique(point_index[inside], return_index=True)
+            areas[members[matched]] = area_ids[area_index[inside][first]]
+        return points, areas
+
     def get_beacons_data(self):
-        client = MongoClient(MONGO_DB)
-        my_db = client["beacons"]
-        output = list(
+        # a cursor over the fields area assignment needs, which
+        # read_beacons_data reads straight into a PositionBatch
+        my_db = self.client["beacons"]
+        return (
             my_db["beacons_data"]
-            .find({"created_at": {"$gte": self.timestamp}})
+            .find(
+                {"created_at": {"$gte": self.timestamp}},
+                projection=dict({field: 1 for field in POSITION_FIELDS}, _id=0),
+            )
             .sort("_id", -1)
         )
-        return output
 
     def clean_by_rows(self, data):
         current_timestamp = None
@@ -248,32 +407,233 @@ class AreaProcessor:
             rows.extend(new_rows)
         return rows
 
-    def clean_data(self, data):
+    def split_segments(self, starts, candidates, x, y):
+        # A candidate row (gap over 5 s) opens a new segment when both its
+        # rounded x and y differ from the row that opened the current one.
+        # That makes each split depend on the previous one, so this walks
+        # the starts and candidates only, on plain lists
+        split = numpy.zeros(len(x), dtype=bool)
+        rows = numpy.flatnonzero(starts | candidates).tolist()
+        is_start = starts[rows].tolist()
+        round_x = numpy.round(x[rows]).tolist()
+        round_y = numpy.round(y[rows]).tolist()
+        current_x = current_y = None
+        for row, start, row_x, row_y in zip(rows, is_start, round_x, round_y):
+            if start or (row_x != current_x and row_y != current_y):
+                split[row] = not start
+                current_x, current_y = row_x, row_y
+        return split
+
+    def sort_segments(self, data):
+        # Positions sorted by beacon, area and time (beacons and their areas
+        # in order of first appearance, as clean_by_beacons visits them),
+        # with the (beacon, area) group of each row and its time in float
+        # seconds, as datetime.timestamp() gives them
         df = pd.DataFrame(data)
-        df = df.sort_values("created_at")
-        return self.clean_by_beacons(df)
+        df = df.sort_values("created_at", kind="mergesort").reset_index(drop=True)
+        beacon_order = pd.factorize(df["beacon"])[0]
+        group_order = df.groupby(["beacon", "area"], sort=False).ngroup().to_numpy()
+        df = df.iloc[numpy.lexsort((numpy.arange(len(df)), group_order, beacon_order))]
+        df = df.reset_index(drop=True)
+        groups = df.groupby(["beacon", "area"], sort=False).ngroup().to_numpy()
+        timestamps = (
+            pd.to_datetime(df["created_at"]).to_numpy().astype("datetime64[us]").astype(numpy.int64) / 1e6
+        )
+        return df, groups, timestamps
+
+    def clean_data(self, data):
+        # Same rows as clean_by_beacons. Segment boundaries come from diff
+        # and cumsum over the sorted positions and the from/to times from
+        # one groupby over segment ids
+        df, groups, timestamps = self.sort_segments(data)
+        x = df["x"].to_numpy(dtype=float)
+        y = df["y"].to_numpy(dtype=float)
+
+        starts = numpy.r_[True, groups[1:] != groups[:-1]]
+        gaps = numpy.r_[0, numpy.diff(timestamps)]
+        splits = self.split_segments(starts, ~starts & (gaps > 5), x, y)
+        segments = numpy.cumsum(starts | splits) - 1
+
+        bounds = (
+            pd.DataFrame({"segment": segments, "timestamp": timestamps})
+            .groupby("segment", sort=True)["timestamp"]
+            .agg(["first", "last"])
+        )
+        # a split row closes the segment before it and reports its own
+        # position; a group of one row becomes a zero-length segment
+        sizes = numpy.bincount(groups)
+        singles = starts & (sizes[groups] == 1)
+        emitted = numpy.flatnonzero(splits | singles)
+        closed = numpy.where(splits[emitted], segments[emitted] - 1, segments[emitted])
+        first = bounds["first"].to_numpy()[closed]
+        last = bounds["last"].to_numpy()[closed]
+
+        rows = df.iloc[emitted][["beacon", "area", "x", "y"]].to_dict("records")
+        output = []
+        for row, single, start, end in zip(rows, singles[emitted].tolist(), first.tolist(), last.tolist()):
+            output.append(
+                {
+                    "from": str(datetime.fromtimestamp(start)),
+                    "to": str(datetime.fromtimestamp(end)),
+                    "time_spent": 0 if single else end - start,
+                    "beacon": row.get("beacon"),
+                    "area": row.get("area"),
+                    "x": row.get("x"),
+                    "y": row.get("y"),
+                }
+            )
+        return output
+
+    def advance_sessions(self, data):
+        # clean_data across runs: each (beacon, area) group continues the
+        # session left open by the previous run instead of starting over.
+        # Rows closed in this run are emitted like clean_data emits them, and
+        # so is the open session of every group that got new positions (it
+        # will be extended again, or closed, by a later run). The sessions
+        # come back with the rows, to be saved once those are posted
+        df, groups, timestamps = self.sort_segments(data)
+        keys = df.groupby(groups, sort=True)[["beacon", "area"]].first()
+        keys = list(keys.itertuples(index=False, name=None))
+        sessions = self.sessions.load(keys)
+
+        # each stored session becomes a virtual first row of its group: it
+        # holds the opening position and the last time seen, and rows up to
+        # that time were already consumed by an earlier run
+        current = numpy.array(
+            [sessions[key]["current"] if key in sessions else -numpy.inf for key in keys]
+        )
+        fresh = timestamps > current[groups]
+        df, groups, timestamps = df[fresh].reset_index(drop=True), groups[fresh], timestamps[fresh]
+        stored = numpy.array([key in sessions for key in keys], dtype=bool)
+        present = numpy.unique(groups)
+        virtual_groups = present[stored[present]]
+        virtual = [sessions[keys[group]] for group in virtual_groups]
+
+        groups = numpy.concatenate([virtual_groups, groups])
+        first_times = numpy.concatenate([[session["first"] for session in virtual], timestamps])
+        timestamps = numpy.concatenate([[session["current"] for session in virtual], timestamps])
+        x = numpy.concatenate([[session["x"] for session in virtual], df["x"].to_numpy(dtype=float)])
+        y = numpy.concatenate([[session["y"] for session in virtual], df["y"].to_numpy(dtype=float)])
+        is_virtual = numpy.r_[numpy.ones(len(virtual), dtype=bool), numpy.zeros(len(df), dtype=bool)]
+        order = numpy.lexsort((timestamps, ~is_virtual, groups))
+        groups, first_times, timestamps = groups[order], first_times[order], timestamps[order]
+        x, y = x[order], y[order]
+        if len(groups) == 0:
+            return [], dict()
+
+        starts = numpy.r_[True, groups[1:] != groups[:-1]]
+        gaps = numpy.r_[0, numpy.diff(timestamps)]
+        splits = self.split_segments(starts, ~starts & (gaps > 5), x, y)
+        segments = numpy.cumsum(starts | splits) - 1
+        opened = numpy.flatnonzero(starts | splits)
+        first = first_times[opened]
+        last = numpy.r_[timestamps[opened[1:] - 1], timestamps[-1]]
+
+        output = []
+        closed = dict()
+        ends = numpy.r_[starts[1:], True]
+        for row in numpy.flatnonzero(splits | ends).tolist():
+            beacon, area = keys[groups[row]]
+            if splits[row]:
+                segment = segments[row] - 1
+                output.append(
+                    {
+                        "from": str(datetime.fromtimestamp(first[segment])),
+                        "to": str(datetime.fromtimestamp(last[segment])),
+                        "time_spent": last[segment] - first[segment],
+                        "beacon": beacon,
+                        "area": area,
+                        "x": float(x[row]),
+                        "y": float(y[row]),
+                    }
+                )
+            if ends[row]:
+                segment = segments[row]
+                opener = opened[segment]
+                session = {
+                    "first": float(first[segment]),
+                    "current": float(last[segment]),
+                    "x": float(x[opener]),
+                    "y": float(y[opener]),
+                }
+                closed[(beacon, area)] = session
+                output.append(
+                    {
+                        "from": str(datetime.fromtimestamp(session["first"])),
+                        "to": str(datetime.fromtimestamp(session["current"])),
+                        "time_spent": session["current"] - session["first"],
+                        "beacon": beacon,
+                        "area": area,
+                        "x": session["x"],
+                        "y": session["y"],
+                    }
+                )
+        return output, closed
 
     def post_positions(self, data):
-        url = MAIN_API_URL + "/api/positions"
-        headers = {"Authorization": f"Bearer {MAIN_API_TOKEN}"}
-        body = {"positions": data}
-        response = requests.put(url, json=body, headers=headers).json()
+        result = PositionsClient().put(data)
+        if result["failed"] > 0:
+            # the run fails before any mark is committed, so the next one
+            # sends this window again
+            raise RuntimeError(f"positions not posted: {result['failed']} of {len(data)}")
+        return result
 
     def proccess_areas(self):
-        rows = []
-        for beacon in self.beacons_data:
-            try:
-                row = self.process_beacons_data(beacon)
-                if row is not None:
-                    rows.append(row)
-            except Exception as e:
-                continue
+        return self.process_positions(self.beacons_data)
+
+    def process_positions(self, data):
+        # positions come as a PositionBatch, read from beacons_data or
+        # handed over by the coords processor
+        data.beacons = data.beacons.remove_unused_categories()
+        self.prefetch_facilities(data.beacons.categories.tolist())
+        with self.stats.stage("area_assignment") as stage:
+            stage.rows_in = len(data)
+            points, areas = self.assign_areas(data)
+            found = numpy.not_equal(areas, None)
+            rows = pd.DataFrame(
+                {
+                    "beacon": data.beacons.astype(object)[found],
+                    "area": areas[found],
+                    "x": points[found, 0],
+                    "y": points[found, 1],
+                    "created_at": data.created_at[found],
+                }
+            )
+            stage.rows_out = len(rows)
         if len(rows) > 0:
-            body = self.clean_data(rows)
-            self.post_positions(body)
+            with self.stats.stage("clean") as stage:
+                stage.rows_in = len(rows)
+                closed = None
+                if self.sessions is not None:
+                    body, closed = self.advance_sessions(rows)
+                else:
+                    body = self.clean_data(rows)
+                stage.rows_out = len(body)
+            with self.stats.stage("post") as stage:
+                stage.rows_in = len(body)
+                result = self.post_positions(body)
+                stage.rows_out = result["sent"]
+            if closed is not None:
+                # sessions only move once their segments are posted
+                self.sessions.save(closed)
             return body
         return []
 
+    def finish_run(self, rows):
+        if len(self.beacons_data) > 0:
+            self.watermark.commit(self.beacons_data.max_created_at())
+        log.info("rows created: %d", len(rows))
+        log.debug("rows created: %s", rows)
+
     def main(self):
+        if self.beacons_data is None:
+            self.read_beacons_data()
         rows = self.proccess_areas()
-        print("Rows Created: ", rows)
+        self.finish_run(rows)
+
+    async def main_async(self, io_executor, cpu_executor):
+        loop = asyncio.get_event_loop()
+        if self.beacons_data is None:
+            await loop.run_in_executor(io_executor, self.read_beacons_data)
+        rows = await loop.run_in_executor(cpu_executor, self.proccess_areas)
+        await loop.run_in_executor(io_executor, self.finish_run, rows)
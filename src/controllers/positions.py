@@ -1,25 +1,89 @@
+import asyncio
+import logging
 import numpy
-from pymongo import MongoClient
 import pandas as pd
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import OperationFailure
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import requests
+from multiprocessing import get_context
 import os
 
 from src.controllers.areas import AreaProcessor
+from src.modules.api import get_session
+from src.modules.batches import READING_FIELDS, PositionBatch, ReadingColumns
+from src.modules.cache import TOPOLOGY_API_TIMEOUT, TOPOLOGY_PREFETCH_CONCURRENCY, gateways_cache
+from src.modules.metrics import beacon_lag_seconds
+from src.modules.mongo import get_client
+from src.modules.smoothing import TrackSmoother, TrackStore
+from src.modules.stats import Stats
+from src.modules.watermark import Watermark
+
+log = logging.getLogger(__name__)
+
+SOLVERS = ["trilateration", "least_squares"]
+SMOOTHING_METHODS = ["none", "ema", "kalman"]
 
 
 class CoordsProcesor:
-    def __init__(self, params):
+    # the processor a run hands its positions to
+    areas_class = AreaProcessor
+
+    def __init__(self, params, client=None):
         super(CoordsProcesor, self).__init__()
         self.url = f"{os.getenv('MAIN_API_URL')}/api/gateways"
-        self.MONGO_DB = os.getenv("MONGO_DB")
+        self.client = client if client is not None else get_client()
         self.headers = {"Authorization": f"Bearer {os.getenv('MAIN_API_TOKEN')}"}
-        self.timestamp = datetime.fromisoformat(params.get("timestamp"))
-        self.gateways = []
+        self.watermark = Watermark(self.client, "positions")
+        self.timestamp = self.watermark.resolve(params.get("timestamp"))
+        self.backfill = params.get("timestamp") is not None
+        self.last_created_at = None
+        self.solver = params.get("solver") or os.getenv("POSITIONS_SOLVER", "trilateration")
+        if self.solver not in SOLVERS:
+            raise ValueError(f"unknown solver {self.solver}")
+        # a request can't start more processes than POSITIONS_MAX_WORKERS,
+        # the host's cores by default
+        max_workers = int(os.getenv("POSITIONS_MAX_WORKERS", os.cpu_count() or 1))
+        workers = int(params.get("workers") or os.getenv("POSITIONS_WORKERS", 1))
+        self.workers = max(1, min(workers, max_workers))
+        self.stats = params.get("stats") or Stats()
+        self.batch_size = int(params.get("batch_size") or os.getenv("POSITIONS_BATCH_SIZE", 5000))
+        self.chunk_size = int(params.get("chunk_size") or os.getenv("POSITIONS_CHUNK_SIZE", 100000))
+        # a pipelined run hands its positions straight to area assignment,
+        # writing them to beacons_data only if POSITIONS_WRITE stays on
+        self.pipeline = params.get("pipeline")
+        if self.pipeline is None:
+            self.pipeline = os.getenv("POSITIONS_PIPELINE", "false").lower() == "true"
+        self.write_positions = not self.pipeline or os.getenv("POSITIONS_WRITE", "true").lower() == "true"
+        self.area_processor = None
+        self.area_batch = []
+        # "ema" or "kalman" smooth each beacon's track, continuing from the
+        # state the previous run left
+        self.smoothing = params.get("smoothing") or os.getenv("POSITIONS_SMOOTHING", "none")
+        if self.smoothing not in SMOOTHING_METHODS:
+            raise ValueError(f"unknown smoothing {self.smoothing}")
+        self.smoother = TrackSmoother(self.smoothing) if self.smoothing != "none" else None
+        self.tracks = TrackStore(self.client)
+        self.track_states = dict()
+        # readings rejected before solving: negative, farther than the
+        # facility allows, or off their (beacon, gateway) rolling median by
+        # more than threshold MADs (0 turns the median test off)
+        self.outlier_window = int(os.getenv("OUTLIER_WINDOW", 5))
+        self.outlier_threshold = float(os.getenv("OUTLIER_MAD_THRESHOLD", 3.5))
+        self.outlier_min_meters = float(os.getenv("OUTLIER_MIN_METERS", 1.0))
+        self.outlier_diagonal_factor = float(os.getenv("OUTLIER_DIAGONAL_FACTOR", 1.5))
+        self.outlier_margin = float(os.getenv("OUTLIER_MARGIN_METERS", 5.0))
+        self.executor = None
+        self.positions = []
+        self.inserted = 0
+        self.indexed = False
 
     def fetch_gateways(self, mac_address):
-        data = requests.get(
-            self.url, json={"macAddress": mac_address}, headers=self.headers
+        data = get_session().get(
+            self.url,
+            json={"macAddress": mac_address},
+            headers=self.headers,
+            timeout=TOPOLOGY_API_TIMEOUT,
         )
         data = data.json().get("data")
         beacons = [beacon.get("macAddress") for beacon in data.get("beacons")]
@@ -31,41 +95,125 @@ class CoordsProcesor:
             }
         return gateways, beacons
 
-    def get_gateways(self, mac_address):
-        if len(self.gateways) > 0:
-            try:
-                return next(
-                    data.get("gateways")
-                    for data in self.gateways
-                    if mac_address in data.get("beacons")
-                )
-            except StopIteration as e:
-                pass
+    def load_gateways(self, mac_address):
         gateways, beacons = self.fetch_gateways(mac_address)
-        self.gateways.append({"gateways": gateways, "beacons": beacons})
+        return gateways, beacons + [mac_address]
+
+    def get_gateways(self, mac_address):
+        gateways = gateways_cache.get(mac_address)
+        if gateways is None:
+            gateways, beacons = self.load_gateways(mac_address)
+            gateways_cache.put(beacons, gateways)
         return gateways
 
-    def read_data(self):
-        client = MongoClient(self.MONGO_DB)
-        my_db = client["beacons"]
-        df = pd.DataFrame(
-            list(
-                my_db["raw_beacons_data"]
-                .find({"created_at": {"$gte": self.timestamp}})
-                .sort("_id", -1)
+    def prefetch_gateways(self, mac_addresses):
+        # one concurrent pass over the facilities of a chunk instead of a
+        # blocking request per unknown beacon
+        with self.stats.stage("prefetch") as stage:
+            stage.rows_in = len(mac_addresses)
+            stage.rows_out = gateways_cache.prefetch(
+                mac_addresses, self.load_gateways, TOPOLOGY_PREFETCH_CONCURRENCY
             )
-        )
-        if len(df) == 0:
-            return df
+
+    def to_frame(self, rows):
+        if isinstance(rows, ReadingColumns):
+            df = rows.to_frame()
+        else:
+            df = pd.DataFrame(rows, columns=READING_FIELDS)
         df = df[pd.isna(df["meters"]) == False]
-        df = df.sort_values(["mac_address", "created_at"])
+        df["meters"] = df["meters"].round(6)
         return df
 
+    def read_chunks(self):
+        # The cursor streams readings already sorted by (mac_address,
+        # created_at) with only the fields the solver needs. They are
+        # handed out in DataFrames of about chunk_size rows, and a chunk
+        # only ends where a (beacon, timestamp) group does
+        my_db = self.client["beacons"]
+        collection = my_db["raw_beacons_data"]
+        collection.create_index([("mac_address", ASCENDING), ("created_at", ASCENDING)])
+        cursor = collection.find(
+            {"created_at": {"$gte": self.timestamp}, "meters": {"$ne": None}},
+            projection=dict({field: 1 for field in READING_FIELDS}, _id=0),
+            sort=[("mac_address", ASCENDING), ("created_at", ASCENDING)],
+            batch_size=min(self.chunk_size, 10000),
+        )
+        rows = ReadingColumns()
+        last = None
+        for document in cursor:
+            key = (document.get("mac_address"), document.get("created_at"))
+            if len(rows) >= self.chunk_size and key != last:
+                yield self.to_frame(rows)
+                rows = ReadingColumns()
+            rows.append(document)
+            last = key
+        if len(rows) > 0:
+            yield self.to_frame(rows)
+
+    def create_positions_index(self):
+        # Rows duplicated by older runs block the unique index. The upserts
+        # then go through a plain index on the same keys (they still keep
+        # new runs from adding duplicates) until the one-off
+        # src.scripts.dedupe_positions removes them and builds the unique
+        # one. Once either exists no run tries to build it again
+        collection = self.client["beacons"]["beacons_data"]
+        keys = [("beacon", ASCENDING), ("created_at", ASCENDING)]
+        if not any(index["key"] == keys for index in collection.index_information().values()):
+            try:
+                collection.create_index(keys, unique=True)
+            except OperationFailure as e:
+                log.warning("unique positions index not created, see src.scripts.dedupe_positions: %s", e)
+                collection.create_index(keys)
+        self.indexed = True
+
     def insert_clean_positions(self, data):
-        client = MongoClient(self.MONGO_DB)
-        my_db = client["beacons"]
-        my_db["beacons_data"].insert_many(data)
-        return True
+        # upserts keyed on (beacon, created_at) make overlapping runs idempotent
+        my_db = self.client["beacons"]
+        operations = [
+            UpdateOne(
+                {"beacon": position["beacon"], "created_at": position["created_at"]},
+                {"$set": position},
+                upsert=True,
+            )
+            for position in data
+        ]
+        result = my_db["beacons_data"].bulk_write(operations, ordered=False)
+        return result.upserted_count
+
+    def flush_positions(self, partial=True):
+        # with partial=False only whole batches are written and the rest
+        # stays buffered for the next call. Positions become documents only
+        # here, one batch at a time
+        with self.stats.stage("insert") as stage:
+            buffered = PositionBatch.concat(self.positions)
+            end = len(buffered) if partial else len(buffered) - len(buffered) % self.batch_size
+            for start in range(0, end, self.batch_size):
+                batch = buffered.take(slice(start, min(start + self.batch_size, end))).to_records()
+                if not self.indexed:
+                    self.create_positions_index()
+                inserted = self.insert_clean_positions(batch)
+                self.inserted += inserted
+                stage.rows_in += len(batch)
+                stage.rows_out += inserted
+            self.positions = [buffered.take(slice(end, None))] if end < len(buffered) else []
+
+    def buffer_positions(self, data):
+        if self.pipeline:
+            self.area_batch.append(data)
+            if self.area_processor.sessions is not None:
+                # sessions carry segments across batches, so each chunk can
+                # go on as soon as it is solved
+                self.flush_areas()
+        if self.write_positions:
+            self.positions.append(data)
+            if sum(len(batch) for batch in self.positions) >= self.batch_size:
+                self.flush_positions(partial=False)
+
+    def flush_areas(self):
+        batch = PositionBatch.concat(self.area_batch)
+        self.area_batch = []
+        if len(batch) > 0:
+            self.area_processor.process_positions(batch)
 
     def trilateration(self, a, b, c):
         a_positon = a.get("position")
@@ -113,49 +261,348 @@ class CoordsProcesor:
         loc[1] = round(loc[1], 2)
         return loc
 
-    def process_beacon_data(self, beacon, data, gateways):
-        created_ats = data["created_at"].astype(str).unique()
-        outputs = list()
-        errors = list()
-        for created_at in created_ats:
-            local = data[data["created_at"] == created_at]
-            local_sorted = local.sort_values(["meters"])
-            local_gateways = local_sorted.to_dict("records")
-            print(local_gateways)
-            print(gateways)
-            gateways_data = [
-                {"position": gateways[x.get("gateway")], "meters": x.get("meters")}
-                for x in local_gateways
-            ]
-            if len(gateways_data) < 3:
-                errors.append(local)
-                continue
-            a, b, c = gateways_data[:3]
-            x, y = self.trilateration(a, b, c)
-
-            output = {
-                "x": str(x),
-                "y": str(y),
-                "created_at": datetime.fromisoformat(created_at),
-                "beacon": beacon,
-            }
-            outputs.append(output)
+    def batch_trilateration(self, gateway1, gateway2, gateway3, distA, distB, distC):
+        # Same construction as trilateration, applied to N triples at once.
+        # gateway1..3 are (N, 2) arrays and distA..C are (N,) arrays.
+        # Returns the (N, 2) positions and a mask of the rows that could be
+        # solved; degenerate triples (U == 0, Vy == 0, collinear gateways)
+        # are masked out instead of producing NaN
+        gateway1 = numpy.asarray(gateway1, dtype=float)
+        gateway2 = numpy.asarray(gateway2, dtype=float)
+        gateway3 = numpy.asarray(gateway3, dtype=float)
+        distA = numpy.asarray(distA, dtype=float)
+        distB = numpy.asarray(distB, dtype=float)
+        distC = numpy.asarray(distC, dtype=float)
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            # Translate points so that A is at origin
+            gateway2a = gateway2 - gateway1
+            gateway3a = gateway3 - gateway1
+
+            # Rotate points so that B is at x-axis
+            U = numpy.linalg.norm(gateway2a, axis=1)
+            unitvector2 = gateway2a / U[:, None]
+            Vx = numpy.sum(unitvector2 * gateway3a, axis=1)
+            distAC = numpy.linalg.norm(gateway3a, axis=1)
+            Vy = numpy.sqrt(distAC ** 2 - Vx ** 2)
+
+            # apply formula with 3 known slants
+            V = numpy.sqrt(Vx ** 2 + Vy ** 2)
+            rx = (distA ** 2 - distB ** 2 + U ** 2) / (2 * U)
+            ry = (distA ** 2 - distC ** 2 + V ** 2 - (2 * Vx * rx)) / (2 * Vy)
+
+            # rerotate x,y
+            perpendicular = gateway3a - Vx[:, None] * unitvector2
+            unitvector3 = perpendicular / numpy.linalg.norm(perpendicular, axis=1)[:, None]
+            loc = gateway1 + unitvector2 * rx[:, None] + unitvector3 * ry[:, None]
+
+        # Vy comes out of a difference of squares, so collinear gateways leave
+        # a rounding residue instead of an exact zero
+        valid = (U > 0) & (Vy > 1e-6 * distAC) & numpy.isfinite(loc).all(axis=1)
+        loc = numpy.round(loc, 2)
+        return loc, valid
+
+    def get_gateway_positions(self, beacons):
+        rows = []
+        for beacon in beacons:
+            for gateway, position in self.get_gateways(beacon).items():
+                rows.append((beacon, gateway, position.get("x"), position.get("y")))
+        return pd.DataFrame(rows, columns=["mac_address", "gateway", "x", "y"])
+
+    def rolling_median(self, values, groups, window):
+        # centered median over window rows of the same group (rows sorted by
+        # group), fewer at the ends of a group as with min_periods=1
+        half = window // 2
+        rows = numpy.arange(len(values))
+        stacked = numpy.full((len(values), 2 * half + 1), numpy.inf)
+        for column, offset in enumerate(range(-half, half + 1)):
+            source = numpy.clip(rows + offset, 0, len(values) - 1)
+            valid = (groups[source] == groups) & (rows + offset >= 0) & (rows + offset < len(values))
+            stacked[valid, column] = values[source[valid]]
+        stacked.sort(axis=1)
+        counts = numpy.isfinite(stacked).sum(axis=1)
+        return (stacked[rows, (counts - 1) // 2] + stacked[rows, counts // 2]) / 2
+
+    def reject_outliers(self, data, gateways):
+        # gateways holds every gateway of each beacon's facility, as
+        # get_gateway_positions returns them
+        if len(data) == 0:
+            return data
+        meters = data["meters"].to_numpy(dtype=float)
+        # no reading can be much longer than the diagonal of the gateways
+        # of the beacon's facility, not just of the ones that heard it
+        layout = gateways[["x", "y"]].astype(float).groupby(gateways["mac_address"].to_numpy(), sort=False)
+        extent = layout.max() - layout.min()
+        diagonals = numpy.hypot(extent["x"], extent["y"]).to_numpy()
+        diagonal = diagonals[extent.index.get_indexer(data["mac_address"].to_numpy())]
+        limit = diagonal * self.outlier_diagonal_factor + self.outlier_margin
+        keep = numpy.isfinite(meters) & (meters >= 0) & (meters <= limit)
+
+        if self.outlier_threshold > 0 and keep.any():
+            rows = numpy.flatnonzero(keep)
+            beacons = pd.factorize(data["mac_address"].to_numpy()[rows])[0]
+            gateways = pd.factorize(data["gateway"].to_numpy()[rows])[0]
+            created_ats = data["created_at"].to_numpy()[rows]
+            order = numpy.lexsort((created_ats, gateways, beacons))
+            rows, beacons, gateways = rows[order], beacons[order], gateways[order]
+            groups = numpy.cumsum(
+                numpy.r_[True, (beacons[1:] != beacons[:-1]) | (gateways[1:] != gateways[:-1])]
+            )
+            values = meters[rows]
+            median = self.rolling_median(values, groups, self.outlier_window)
+            deviation = numpy.abs(values - median)
+            # 1.4826 scales the MAD to a standard deviation for normal noise
+            mad = 1.4826 * self.rolling_median(deviation, groups, self.outlier_window)
+            keep[rows[deviation > self.outlier_threshold * mad + self.outlier_min_meters]] = False
+        return data[keep]
+
+    def select_nearest_gateways(self, data, amount=3, all_gateways=False):
+        # one sort puts every (beacon, timestamp) group in order of distance,
+        # so the nearest gateways are the first rows of each group
+        data = data.sort_values(["mac_address", "created_at", "meters"], kind="mergesort")
+        groups = data.groupby(["mac_address", "created_at"], sort=False, observed=True)
+        enough = groups["meters"].transform("size") >= amount
+        if all_gateways:
+            return data[enough]
+        nearest = groups.cumcount() < amount
+        return data[enough & nearest]
+
+    def batch_least_squares(self, groups, positions, meters):
+        # Weighted linear least squares over every reading of a group.
+        # groups is the (M,) group index of each reading (contiguous, nearest
+        # reading first), positions the (M, 2) gateway coordinates and meters
+        # the (M,) distances. Subtracting the circle equation of the nearest
+        # gateway from the others leaves a linear system in (x, y), whose
+        # weighted normal equations are accumulated per group with bincount.
+        # Returns the (G, 2) positions, the weighted RMS distance residual of
+        # each position and a mask of the groups that could be solved
+        count = groups.max() + 1 if len(groups) > 0 else 0
+        starts = numpy.flatnonzero(numpy.r_[True, groups[1:] != groups[:-1]])
+        reference = starts[groups]
+
+        # closer readings are less noisy, so they weigh more
+        weights = 1 / numpy.maximum(meters, 0.1) ** 2
+        ax = 2 * (positions[:, 0] - positions[reference, 0])
+        ay = 2 * (positions[:, 1] - positions[reference, 1])
+        b = (
+            meters[reference] ** 2
+            - meters ** 2
+            + (positions ** 2).sum(axis=1)
+            - (positions[reference] ** 2).sum(axis=1)
+        )
+
+        def total(values):
+            return numpy.bincount(groups, weights=weights * values, minlength=count)
+
+        sxx, sxy, syy = total(ax * ax), total(ax * ay), total(ay * ay)
+        sxb, syb = total(ax * b), total(ay * b)
+        det = sxx * syy - sxy ** 2
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            x = (syy * sxb - sxy * syb) / det
+            y = (sxx * syb - sxy * sxb) / det
+        locs = numpy.round(numpy.column_stack([x, y]), 2)
+        # collinear gateways make the normal matrix singular
+        valid = (det > 1e-9 * sxx * syy) & numpy.isfinite(locs).all(axis=1)
+
+        errors = numpy.hypot(*(locs[groups] - positions).T) - meters
+        residuals = numpy.sqrt(
+            numpy.bincount(groups, weights=weights * errors ** 2, minlength=count)
+            / numpy.bincount(groups, weights=weights, minlength=count)
+        )
+        return locs, residuals, valid
+
+    def solve_positions(self, nearest):
+        positions = nearest[["x", "y"]].to_numpy(dtype=float).reshape(-1, 3, 2)
+        meters = nearest["meters"].to_numpy(dtype=float).reshape(-1, 3)
+        keys = nearest.iloc[::3]
+        locs, valid = self.batch_trilateration(
+            positions[:, 0], positions[:, 1], positions[:, 2],
+            meters[:, 0], meters[:, 1], meters[:, 2],
+        )
+        return PositionBatch(
+            keys["mac_address"].to_numpy()[valid],
+            keys["created_at"].to_numpy()[valid],
+            locs[valid, 0],
+            locs[valid, 1],
+        )
+
+    def solve_least_squares(self, readings):
+        groups = readings.groupby(["mac_address", "created_at"], sort=False, observed=True).ngroup().to_numpy()
+        locs, residuals, valid = self.batch_least_squares(
+            groups,
+            readings[["x", "y"]].to_numpy(dtype=float),
+            readings["meters"].to_numpy(dtype=float),
+        )
+        keys = readings[numpy.r_[True, groups[1:] != groups[:-1]]]
+        return PositionBatch(
+            keys["mac_address"].to_numpy()[valid],
+            keys["created_at"].to_numpy()[valid],
+            locs[valid, 0],
+            locs[valid, 1],
+            numpy.round(residuals[valid], 4),
+        )
+
+    def smooth_positions(self, outputs):
+        with self.stats.stage("smoothing") as stage:
+            stage.rows_in = len(outputs)
+            beacons = outputs.beacons.astype(object)
+            unknown = set(beacons).difference(self.track_states)
+            self.track_states.update(self.tracks.load(unknown))
+            points = outputs.points()
+            x, y, kept, states = self.smoother.smooth(
+                beacons,
+                outputs.created_at.astype(numpy.int64) / 1e6,
+                points[:, 0],
+                points[:, 1],
+                self.track_states,
+                resume=not self.backfill,
+            )
+            outputs.x = numpy.round(x, 2).astype(numpy.float32)
+            outputs.y = numpy.round(y, 2).astype(numpy.float32)
+            for beacon, state in states.items():
+                # a backfill behind the stored state doesn't replace it
+                stored = self.track_states.get(beacon)
+                if stored is None or stored.get("t") is None or state["t"] >= stored["t"]:
+                    self.track_states[beacon] = state
+            # positions skipped on the way in keep the smoothed values the
+            # previous run wrote
+            outputs = outputs.take(kept)
+            stage.rows_out = len(outputs)
         return outputs
 
+    def compute_positions(self, data):
+        if self.solver == "least_squares":
+            readings = self.select_nearest_gateways(data, all_gateways=True)
+            return self.solve_least_squares(readings)
+        nearest = self.select_nearest_gateways(data)
+        return self.solve_positions(nearest)
+
+    def process_shards(self, data):
+        # beacons never span shards, so every (beacon, timestamp) group is
+        # solved whole by one worker
+        shards = pd.util.hash_array(data["mac_address"].to_numpy()) % self.workers
+        params = {"timestamp": str(self.timestamp), "solver": self.solver}
+        if self.executor is None:
+            # spawned workers don't inherit the parent's threads or Mongo
+            # sockets; the pool lives for the whole run, across chunks
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=get_context("spawn")
+            )
+        futures = [
+            self.executor.submit(process_shard, params, shard)
+            for _, shard in data.groupby(shards, sort=False)
+        ]
+        return PositionBatch.concat([future.result() for future in futures])
+
     def process_data(self, data):
+        if len(data) == 0:
+            return 0
+        last_created_at = data["created_at"].max().to_pydatetime()
+        if self.last_created_at is None or last_created_at > self.last_created_at:
+            self.last_created_at = last_created_at
         beacons = data["mac_address"].unique()
-        amount = 0
-        for beacon in beacons:
-            gateways = self.get_gateways(beacon)
-            beacon_data = data[data["mac_address"] == beacon]
-            beacon_output = self.process_beacon_data(beacon, beacon_data, gateways)
-            amount += len(beacon_output)
-            self.insert_clean_positions(beacon_output)
-        print(f"total of {amount} positions saved")
+        self.prefetch_gateways(beacons)
+        with self.stats.stage("filter") as stage:
+            stage.rows_in = len(data)
+            gateways = self.get_gateway_positions(beacons)
+            # readings from gateways outside the beacon's facility can't be placed
+            data = data.merge(gateways, on=["mac_address", "gateway"], how="inner")
+            data = self.reject_outliers(data, gateways)
+            stage.rows_out = len(data)
+        with self.stats.stage("trilateration") as stage:
+            stage.rows_in = len(data)
+            if self.workers > 1:
+                outputs = self.process_shards(data)
+            else:
+                outputs = self.compute_positions(data)
+            stage.rows_out = len(outputs)
+        if self.smoother is not None:
+            outputs = self.smooth_positions(outputs)
+        # how far behind the readings each beacon's positions are solved
+        latest = data.groupby("mac_address", sort=False, observed=True)["created_at"].max()
+        beacon_lag_seconds.observe_many((pd.Timestamp(datetime.utcnow()) - latest).dt.total_seconds())
+        self.buffer_positions(outputs)
+        return len(outputs)
+
+    def area_timestamp(self):
+        # an incremental run has areas resume from their own watermark,
+        # which lags behind this one when an earlier area step failed
+        watermark = Watermark(self.client, "areas")
+        if self.backfill or watermark.get() is None:
+            return self.timestamp
+        return min(self.timestamp, watermark.resolve())
+
+    def start_run(self):
+        area_processor = self.areas_class(
+            {"timestamp": str(self.area_timestamp()), "stats": self.stats}, client=self.client
+        )
+        if self.pipeline:
+            self.area_processor = area_processor
+        return area_processor
+
+    def read_chunk(self, chunks):
+        with self.stats.stage("read_data") as stage:
+            df = next(chunks, None)
+            stage.rows_out = len(df) if df is not None else 0
+        return df
+
+    def finish_run(self, area_processor, amount):
+        self.flush_positions()
+        log.info("total of %d positions saved, %d new", amount, self.inserted)
+        if self.pipeline:
+            self.flush_areas()
+            if self.last_created_at is not None:
+                area_processor.watermark.commit(self.last_created_at)
+        else:
+            area_processor.main()
+        # the mark only moves once the areas of these positions are
+        # assigned, so a failed area step is retried by the next run (a
+        # pipelined run without POSITIONS_WRITE has them nowhere else).
+        # Track states move with it, or the retry would skip those fixes
+        self.tracks.save(self.track_states)
+        if self.last_created_at is not None:
+            self.watermark.commit(self.last_created_at)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
     def main(self):
-        df = self.read_data()
-        df["meters"] = df["meters"].round(6)
-        self.process_data(df)
-        area_processor = AreaProcessor({"timestamp": str(self.timestamp)})
-        area_processor.main()
+        amount = 0
+        area_processor = self.start_run()
+        chunks = self.read_chunks()
+        try:
+            while True:
+                df = self.read_chunk(chunks)
+                if df is None:
+                    break
+                amount += self.process_data(df)
+        finally:
+            self.shutdown()
+        self.finish_run(area_processor, amount)
+
+    async def main_async(self, io_executor, cpu_executor):
+        # main on an event loop: the next chunk is read on the I/O executor
+        # while the current one is solved on the CPU executor
+        loop = asyncio.get_event_loop()
+        amount = 0
+        area_processor = await loop.run_in_executor(io_executor, self.start_run)
+        chunks = self.read_chunks()
+        reading = loop.run_in_executor(io_executor, self.read_chunk, chunks)
+        try:
+            while True:
+                df = await reading
+                if df is None:
+                    break
+                reading = loop.run_in_executor(io_executor, self.read_chunk, chunks)
+                amount += await loop.run_in_executor(cpu_executor, self.process_data, df)
+        finally:
+            # the generator can't be closed while a read is still using it
+            await asyncio.wait([reading])
+            await loop.run_in_executor(io_executor, self.shutdown)
+        await loop.run_in_executor(io_executor, self.finish_run, area_processor, amount)
+
+
+def process_shard(params, data):
+    return CoordsProcesor(params).compute_positions(data)
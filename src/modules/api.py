@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from time import sleep
+from urllib.parse import urlparse
+import requests
+import gzip
+import json
+import logging
+import os
+
+from src.modules.metrics import http_requests
+
+log = logging.getLogger(__name__)
+
+session = None
+session_pid = None
+lock = Lock()
+
+
+def count_response(response, *args, **kwargs):
+    request = response.request
+    http_requests.inc(method=request.method, path=urlparse(request.url).path, status=response.status_code)
+
+
+def create_session():
+    pool_size = int(os.getenv("API_POOL_SIZE", 10))
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+    http.headers.update({"Authorization": f"Bearer {os.getenv('MAIN_API_TOKEN')}"})
+    http.hooks["response"].append(count_response)
+    return http
+
+
+def get_session():
+    # one keep-alive pool per process, like the Mongo client
+    global session, session_pid
+    with lock:
+        if session is None or session_pid != os.getpid():
+            session = create_session()
+            session_pid = os.getpid()
+        return session
+
+
+def reset_session():
+    global session, session_pid
+    session = None
+    session_pid = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_session)
+
+
+class RetryableError(Exception):
+    pass
+
+
+class PositionsClient:
+    # Sends cleaned positions to the main API in chunks of chunk_size rows,
+    # up to concurrency requests at a time. Timeouts, connection errors and
+    # 5xx answers are retried with exponential backoff; a chunk that still
+    # fails (or gets a 4xx) is counted as failed and the rest go on
+    def __init__(self, url=None):
+        self.url = url or f"{os.getenv('MAIN_API_URL')}/api/positions"
+        self.chunk_size = int(os.getenv("POSITIONS_API_CHUNK_SIZE", 1000))
+        self.concurrency = int(os.getenv("POSITIONS_API_CONCURRENCY", 4))
+        self.retries = int(os.getenv("POSITIONS_API_RETRIES", 3))
+        self.backoff = float(os.getenv("POSITIONS_API_BACKOFF", 0.5))
+        self.timeout = float(os.getenv("POSITIONS_API_TIMEOUT", 30))
+        self.compress = os.getenv("POSITIONS_API_GZIP", "true").lower() == "true"
+        self.session = get_session()
+
+    def encode(self, chunk):
+        body = json.dumps({"positions": chunk}).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.compress:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        return body, headers
+
+    def send(self, chunk):
+        body, headers = self.encode(chunk)
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.put(self.url, data=body, headers=headers, timeout=self.timeout)
+                if response.status_code >= 500:
+                    raise RetryableError(f"status {response.status_code}")
+                if response.status_code >= 400:
+                    log.warning("positions chunk rejected: status %s %s", response.status_code, response.text[:200])
+                    return False
+                return True
+            except (requests.Timeout, requests.ConnectionError, RetryableError) as error:
+                if not isinstance(error, RetryableError):
+                    http_requests.inc(method="PUT", path=urlparse(self.url).path, status="error")
+                if attempt == self.retries:
+                    log.warning("positions chunk failed after %d attempts: %s", attempt + 1, error)
+                    return False
+                sleep(self.backoff * 2 ** attempt)
+
+    def put(self, rows):
+        chunks = [rows[i : i + self.chunk_size] for i in range(0, len(rows), self.chunk_size)]
+        sent = failed = 0
+        if len(chunks) == 0:
+            return {"sent": sent, "failed": failed}
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(chunks))) as executor:
+            for chunk, ok in zip(chunks, executor.map(self.send, chunks)):
+                if ok:
+                    sent += len(chunk)
+                else:
+                    failed += len(chunk)
+        return {"sent": sent, "failed": failed}
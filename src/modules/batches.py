@@ -0,0 +1,175 @@
+from array import array
+from datetime import datetime, timedelta
+import numpy
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+READING_FIELDS = ["mac_address", "gateway", "meters", "created_at"]
+POSITION_FIELDS = ["beacon", "x", "y", "created_at"]
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+# datetime64's NaT as an int64
+NAT = numpy.iinfo(numpy.int64).min
+
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+
+
+def to_micros(value):
+    if value is None:
+        return NAT
+    if not isinstance(value, datetime):
+        value = pd.Timestamp(value)
+    return (value - EPOCH) // MICROSECOND
+
+
+class Codes:
+    # One int32 code per row and every distinct value once, as a
+    # categorical is stored. None gets -1, a missing value
+    def __init__(self):
+        self.index = dict()
+        self.codes = array("i")
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, value):
+        if value is None:
+            self.codes.append(-1)
+            return
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.index)
+        self.codes.append(code)
+
+    def to_categorical(self):
+        # categories sorted, as pd.Categorical sorts them
+        categories = numpy.array(list(self.index), dtype=object)
+        order = numpy.argsort(categories, kind="stable")
+        recode = numpy.empty(len(order) + 1, dtype=numpy.int32)
+        recode[order] = numpy.arange(len(order))
+        recode[-1] = -1
+        codes = recode[numpy.frombuffer(self.codes, dtype=numpy.intc)]
+        return pd.Categorical.from_codes(codes, categories=categories[order])
+
+
+class ReadingColumns:
+    # raw_beacons_data documents gathered straight into typed columns: a
+    # code per MAC and gateway, float64 meters and created_at in int64
+    # microseconds, so a chunk holds no Python object per reading
+    def __init__(self):
+        self.mac_addresses = Codes()
+        self.gateways = Codes()
+        self.meters = array("d")
+        self.created_at = array("q")
+
+    def __len__(self):
+        return len(self.created_at)
+
+    def append(self, document):
+        self.mac_addresses.append(document.get("mac_address"))
+        self.gateways.append(document.get("gateway"))
+        self.meters.append(to_float(document.get("meters")))
+        self.created_at.append(to_micros(document.get("created_at")))
+
+    def to_frame(self):
+        return pd.DataFrame(
+            {
+                "mac_address": self.mac_addresses.to_categorical(),
+                "gateway": self.gateways.to_categorical(),
+                "meters": numpy.frombuffer(self.meters, dtype=float),
+                "created_at": numpy.frombuffer(self.created_at, dtype="datetime64[us]"),
+            }
+        )
+
+
+class PositionBatch:
+    # Solved positions as columns: categorical beacons, created_at in
+    # datetime64[us], x and y in float32 (positions are rounded to the
+    # centimetre, which float32 holds closely enough to round back) and an
+    # optional least squares residual. Dicts only exist at the Mongo and
+    # HTTP boundaries, through from_records and to_records
+    def __init__(self, beacons, created_at, x, y, residual=None):
+        self.beacons = pd.Categorical(beacons)
+        self.created_at = numpy.asarray(created_at, dtype="datetime64[us]")
+        self.x = numpy.asarray(x, dtype=numpy.float32)
+        self.y = numpy.asarray(y, dtype=numpy.float32)
+        self.residual = None if residual is None else numpy.asarray(residual, dtype=float)
+
+    def __len__(self):
+        return len(self.created_at)
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], [])
+
+    @classmethod
+    def from_records(cls, records):
+        # records is any iterable of position documents, a cursor is read
+        # one document at a time into typed columns
+        beacons, created_at, x, y = Codes(), array("q"), array("f"), array("f")
+        for record in records:
+            beacons.append(record.get("beacon"))
+            created_at.append(to_micros(record.get("created_at")))
+            x.append(to_float(record.get("x")))
+            y.append(to_float(record.get("y")))
+        return cls(
+            beacons.to_categorical(),
+            numpy.frombuffer(created_at, dtype="datetime64[us]"),
+            numpy.frombuffer(x, dtype=numpy.float32),
+            numpy.frombuffer(y, dtype=numpy.float32),
+        )
+
+    @classmethod
+    def concat(cls, batches):
+        batches = [batch for batch in batches if len(batch) > 0]
+        if len(batches) == 0:
+            return cls.empty()
+        if len(batches) == 1:
+            return batches[0]
+        residual = None
+        if all(batch.residual is not None for batch in batches):
+            residual = numpy.concatenate([batch.residual for batch in batches])
+        return cls(
+            union_categoricals([batch.beacons for batch in batches]),
+            numpy.concatenate([batch.created_at for batch in batches]),
+            numpy.concatenate([batch.x for batch in batches]),
+            numpy.concatenate([batch.y for batch in batches]),
+            residual,
+        )
+
+    def take(self, rows):
+        return PositionBatch(
+            self.beacons[rows],
+            self.created_at[rows],
+            self.x[rows],
+            self.y[rows],
+            None if self.residual is None else self.residual[rows],
+        )
+
+    def points(self):
+        # back to the float64 centimetre values the solver produced
+        return numpy.column_stack(
+            [numpy.round(self.x.astype(float), 2), numpy.round(self.y.astype(float), 2)]
+        )
+
+    def max_created_at(self):
+        return self.created_at.max().tolist() if len(self) > 0 else None
+
+    def to_records(self):
+        points = self.points()
+        records = [
+            {"x": str(x), "y": str(y), "created_at": created_at, "beacon": beacon}
+            for (x, y), created_at, beacon in zip(
+                points.tolist(), self.created_at.tolist(), self.beacons.astype(object).tolist()
+            )
+        ]
+        if self.residual is not None:
+            for record, residual in zip(records, self.residual.tolist()):
+                record["residual"] = residual
+        return records
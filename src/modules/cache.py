@@ -0,0 +1,142 @@
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock
+from time import monotonic
+import logging
+import os
+
+from src.modules.metrics import Gauge, registry
+
+log = logging.getLogger(__name__)
+
+
+class TopologyCache:
+    # Facility topologies (gateway layouts, area vertices) shared by every
+    # job in the process. Each entry holds one facility and a MAC -> entry
+    # index makes lookups O(1). Entries expire after ttl seconds and the
+    # least recently used one is dropped past size entries
+    def __init__(self, ttl=300, size=256):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.index = dict()
+        self.next_key = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def remove(self, key):
+        value, beacons, expires_at = self.entries.pop(key)
+        for beacon in beacons:
+            if self.index.get(beacon) == key:
+                del self.index[beacon]
+
+    def get(self, mac_address):
+        with self.lock:
+            key = self.index.get(mac_address)
+            if key is not None and self.entries[key][2] <= monotonic():
+                self.remove(key)
+                key = None
+            if key is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+    def contains(self, mac_address):
+        # like get, without touching the LRU order or the hit counters
+        with self.lock:
+            key = self.index.get(mac_address)
+            return key is not None and self.entries[key][2] > monotonic()
+
+    def prefetch(self, mac_addresses, load, concurrency=8):
+        # Fills the cache for every MAC not in it yet. load(mac) returns the
+        # (value, beacons) of its facility, so one load covers all of its
+        # beacons. The first MAC is loaded alone (a chunk often spans one
+        # facility), then up to concurrency loads run at once and a MAC is
+        # only sent if no finished load has covered it yet
+        pending = [mac for mac in dict.fromkeys(mac_addresses) if not self.contains(mac)]
+        running = dict()
+        loaded = 0
+        finished = False
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            while True:
+                pending = [mac for mac in pending if not self.contains(mac)]
+                slots = (max(concurrency, 1) if finished else 1) - len(running)
+                while slots > 0 and len(pending) > 0:
+                    mac = pending.pop(0)
+                    running[executor.submit(load, mac)] = mac
+                    slots -= 1
+                if len(running) == 0:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                finished = True
+                for future in done:
+                    mac = running.pop(future)
+                    try:
+                        value, beacons = future.result()
+                    except Exception as e:
+                        # left to the lazy lookup, which handles its own errors
+                        log.warning("prefetch of %s failed: %s", mac, e)
+                        continue
+                    self.put(beacons, value)
+                    loaded += 1
+        return loaded
+
+    def put(self, beacons, value):
+        with self.lock:
+            # a facility fetched again replaces its previous entry
+            for beacon in beacons:
+                key = self.index.get(beacon)
+                if key is not None and key in self.entries:
+                    self.remove(key)
+            key = self.next_key
+            self.next_key += 1
+            self.entries[key] = (value, list(beacons), monotonic() + self.ttl)
+            for beacon in beacons:
+                self.index[beacon] = key
+            while len(self.entries) > self.size:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.index.clear()
+
+    def to_dict(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups > 0 else None,
+                "evictions": self.evictions,
+                "facilities": len(self.entries),
+                "beacons": len(self.index),
+            }
+
+
+TOPOLOGY_CACHE_TTL = float(os.getenv("TOPOLOGY_CACHE_TTL", 300))
+TOPOLOGY_CACHE_SIZE = int(os.getenv("TOPOLOGY_CACHE_SIZE", 256))
+TOPOLOGY_PREFETCH_CONCURRENCY = int(os.getenv("TOPOLOGY_PREFETCH_CONCURRENCY", 8))
+# a hung topology request fails the load instead of holding a prefetch
+TOPOLOGY_API_TIMEOUT = float(os.getenv("TOPOLOGY_API_TIMEOUT", 10))
+
+gateways_cache = TopologyCache(ttl=TOPOLOGY_CACHE_TTL, size=TOPOLOGY_CACHE_SIZE)
+areas_cache = TopologyCache(ttl=TOPOLOGY_CACHE_TTL, size=TOPOLOGY_CACHE_SIZE)
+
+
+def cache_stats():
+    values = dict()
+    for name, cache in (("gateways", gateways_cache), ("areas", areas_cache)):
+        for stat, value in cache.to_dict().items():
+            values[(name, stat)] = value
+    return values
+
+
+registry.register(
+    Gauge("positions_topology_cache", "Topology cache hits, misses, ratio and size", ["cache", "stat"], cache_stats)
+)
@@ -1,18 +1,22 @@
-import time
 from threading import Thread
+import logging
+
+log = logging.getLogger(__name__)
+
 
 class Compute(Thread):
-    def __init__(self, request, class_name, params=None):
+    def __init__(self, jobs):
         Thread.__init__(self)
-        self.request = request
-        self.class_name = class_name
-        self.params = params
+        self.jobs = jobs
 
     def run(self):
-        print("start")
-        if self.params is None:
-            class_instance = self.class_name()
-        else:
-            class_instance = self.class_name(self.params)
-        class_instance.main()
-        print("done")
+        while True:
+            job = self.jobs.get()
+            log.info("start %s", job.id)
+            try:
+                job.run()
+            except Exception as e:
+                log.error("job %s failed: %s", job.id, e)
+            finally:
+                self.jobs.done(job)
+            log.info("done %s", job.id)
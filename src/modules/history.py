@@ -0,0 +1,31 @@
+from datetime import datetime
+from pymongo import ASCENDING
+import os
+
+from src.modules.mongo import get_client
+
+
+class JobHistory:
+    # Job records shared by every gunicorn worker: Job.to_record, saved
+    # when the job is queued, when it starts, after each stage and when it
+    # ends. Mongo drops a record JOB_HISTORY_TTL seconds after its last save
+    def __init__(self, ttl=None):
+        self.ttl = int(ttl or os.getenv("JOB_HISTORY_TTL", 604800))
+        self.indexed = False
+
+    def get_collection(self):
+        return get_client()["beacons"]["jobs"]
+
+    def save(self, job):
+        collection = self.get_collection()
+        if not self.indexed:
+            collection.create_index([("updated_at", ASCENDING)], expireAfterSeconds=self.ttl)
+            self.indexed = True
+        record = dict(job.to_record(), updated_at=datetime.utcnow())
+        collection.update_one({"_id": job.id}, {"$set": record}, upsert=True)
+
+    def find(self, job_id):
+        record = self.get_collection().find_one({"_id": job_id})
+        if record is None:
+            return None
+        return {field: value for field, value in record.items() if field not in ("_id", "updated_at")}
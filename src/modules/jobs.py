@@ -0,0 +1,219 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+from collections import OrderedDict
+from datetime import datetime
+from queue import Queue, Full
+from threading import Lock
+from uuid import uuid4
+
+from src.modules.compute import Compute
+from src.modules.metrics import job_seconds, jobs_total
+from src.modules.stats import Stats
+
+log = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, class_name, params=None, profile=False, history=None):
+        self.id = uuid4().hex
+        self.class_name = class_name
+        self.params = params
+        # identical pending jobs (same processor, window and options) are
+        # coalesced, a trigger differing in any param runs on its own
+        options = repr(sorted((params or {}).items()))
+        self.key = (class_name.__name__, options, profile)
+        self.state = "pending"
+        self.error = None
+        # with a history (a JobHistory) the record is saved as the job goes,
+        # for the workers that didn't run it
+        self.history = history
+        self.lock = Lock()
+        self.stats = Stats(listener=self.save)
+        self.created_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        # with profile on, the run goes under cProfile and the report is kept
+        self.profile = profile
+        self.profile_report = None
+
+    def create(self):
+        if self.params is None:
+            return self.class_name()
+        return self.class_name(dict(self.params, stats=self.stats))
+
+    def main(self):
+        class_instance = self.create()
+        if not self.profile:
+            class_instance.main()
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(class_instance.main)
+        finally:
+            report = io.StringIO()
+            stats = pstats.Stats(profiler, stream=report)
+            stats.sort_stats("cumulative").print_stats(int(os.getenv("JOB_PROFILE_LINES", 40)))
+            self.profile_report = report.getvalue()
+
+    def save(self):
+        if self.history is None:
+            return
+        # one save at a time, so an older record never overwrites a newer one
+        with self.lock:
+            try:
+                self.history.save(self)
+            except Exception as e:
+                log.warning("job %s not saved: %s", self.id, e)
+
+    def begin(self):
+        self.state = "running"
+        self.started_at = datetime.utcnow()
+        self.save()
+
+    def finish(self):
+        self.finished_at = datetime.utcnow()
+        jobs_total.inc(processor=self.key[0], state=self.state)
+        job_seconds.observe((self.finished_at - self.started_at).total_seconds(), processor=self.key[0])
+        self.save()
+
+    def run(self):
+        self.begin()
+        try:
+            self.main()
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            raise
+        else:
+            self.state = "done"
+        finally:
+            self.finish()
+
+    async def run_async(self, io_executor, cpu_executor):
+        # processors with a main_async schedule their own I/O and CPU
+        # stages, the rest run whole on the CPU executor. cProfile only sees
+        # its own thread, so profiled jobs also run whole
+        loop = asyncio.get_event_loop()
+        if self.profile:
+            return await loop.run_in_executor(cpu_executor, self.run)
+        await loop.run_in_executor(io_executor, self.begin)
+        try:
+            class_instance = await loop.run_in_executor(io_executor, self.create)
+            if hasattr(class_instance, "main_async"):
+                await class_instance.main_async(io_executor, cpu_executor)
+            else:
+                await loop.run_in_executor(cpu_executor, class_instance.main)
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            raise
+        else:
+            self.state = "done"
+        finally:
+            await loop.run_in_executor(io_executor, self.finish)
+
+    def to_dict(self):
+        def isoformat(value):
+            return value.isoformat() if value is not None else None
+
+        seconds = None
+        if self.started_at is not None and self.finished_at is not None:
+            seconds = (self.finished_at - self.started_at).total_seconds()
+        return {
+            "id": self.id,
+            "processor": self.key[0],
+            "timestamp": self.params.get("timestamp") if self.params is not None else None,
+            "state": self.state,
+            "error": self.error,
+            "created_at": isoformat(self.created_at),
+            "started_at": isoformat(self.started_at),
+            "finished_at": isoformat(self.finished_at),
+            "seconds": seconds,
+            "profiled": self.profile_report is not None,
+            "stages": self.stats.to_dict(),
+        }
+
+    def to_record(self):
+        return dict(self.to_dict(), profile_report=self.profile_report)
+
+
+class JobQueue:
+    # With leases (a JobLeases) the coalescing and both limits hold across
+    # every process sharing the Mongo database, not just this one
+    def __init__(self, workers=2, size=16, history=1000, leases=None, store=None):
+        self.workers = workers
+        self.queue = Queue(maxsize=size)
+        self.pending = dict()
+        self.leases = leases
+        # finished jobs stay queryable until they fall out of the history,
+        # or for as long as the store (a JobHistory) keeps them
+        self.history = history
+        self.store = store
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+        self.threads = []
+
+    def start(self):
+        # workers start on the first submit so nothing runs before gunicorn forks
+        if len(self.threads) > 0:
+            return
+        for _ in range(self.workers):
+            thread = Compute(self)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, class_name, params=None, profile=False):
+        # returns the id of the job that will run, an identical pending
+        # job's if there is one
+        job = Job(class_name, params, profile, history=self.store)
+        with self.lock:
+            self.start()
+            pending = self.pending.get(job.key)
+            if pending is not None:
+                return pending.id
+            if self.leases is not None:
+                holder = self.leases.claim(job)
+                if holder != job.id:
+                    return holder
+            job.save()
+            try:
+                self.queue.put_nowait(job)
+            except Full:
+                if self.leases is not None:
+                    self.leases.release(job)
+                raise QueueFull(f"{self.queue.maxsize} jobs already pending")
+            self.pending[job.key] = job
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+        return job.id
+
+    def find(self, job_id):
+        # the record of a job run by any worker, see Job.to_record
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_record()
+        if self.store is not None:
+            return self.store.find(job_id)
+        return None
+
+    def get(self):
+        job = self.queue.get()
+        if self.leases is not None:
+            self.leases.wait(job)
+        with self.lock:
+            self.pending.pop(job.key, None)
+        return job
+
+    def done(self, job):
+        if self.leases is not None:
+            self.leases.release(job)
@@ -0,0 +1,164 @@
+from datetime import datetime, timedelta
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+from threading import Lock, Thread
+from time import sleep
+import logging
+import os
+
+from src.modules.jobs import QueueFull
+from src.modules.mongo import get_client
+
+log = logging.getLogger(__name__)
+
+EXPIRED = datetime(1970, 1, 1)
+
+
+class LeaseStore:
+    # Claims shared by every gunicorn worker (and host) through Mongo. A
+    # lease is a document held by one holder until it is released or
+    # expires. A process renews the leases it holds every ttl / 3, so only
+    # the leases of a process that died run out
+    def __init__(self, ttl=None):
+        self.ttl = timedelta(seconds=float(ttl or os.getenv("JOB_LEASE_TTL", 300)))
+        self.held = dict()
+        self.lock = Lock()
+        self.thread = None
+        self.indexed = False
+
+    def get_collection(self):
+        # the client of the current process, leases are only taken after
+        # gunicorn forks
+        return get_client()["beacons"]["job_leases"]
+
+    def acquire(self, name, holder):
+        # returns who holds the lease now, holder itself if it was free
+        collection = self.get_collection()
+        if not self.indexed:
+            # expired leases are dropped by Mongo
+            collection.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+            self.indexed = True
+        for _ in range(3):
+            now = datetime.utcnow()
+            try:
+                collection.update_one(
+                    {"_id": name, "expires_at": {"$lt": now}},
+                    {"$set": {"holder": holder, "expires_at": now + self.ttl}},
+                    upsert=True,
+                )
+            except DuplicateKeyError:
+                document = collection.find_one({"_id": name})
+                # a lease released between both calls is tried again
+                if document is not None and document["expires_at"] >= now:
+                    return document["holder"]
+                continue
+            with self.lock:
+                self.held[name] = holder
+            self.start()
+            return holder
+        raise RuntimeError(f"lease {name} not acquired")
+
+    def acquire_slot(self, prefix, limit, holder):
+        # one of limit leases named prefix|0 to prefix|limit - 1, None if
+        # all of them are held
+        names = [f"{prefix}|{slot}" for slot in range(limit)]
+        held = self.get_collection().find(
+            {"_id": {"$in": names}, "expires_at": {"$gte": datetime.utcnow()}}, projection={"_id": 1}
+        )
+        held = set(document["_id"] for document in held)
+        for name in names:
+            if name not in held and self.acquire(name, holder) == holder:
+                return name
+        return None
+
+    def release(self, name, holder):
+        with self.lock:
+            self.held.pop(name, None)
+        self.get_collection().update_one({"_id": name, "holder": holder}, {"$set": {"expires_at": EXPIRED}})
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = Thread(target=self.renew)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def renew(self):
+        while True:
+            sleep(self.ttl.total_seconds() / 3)
+            with self.lock:
+                held = list(self.held.items())
+            expires_at = datetime.utcnow() + self.ttl
+            for name, holder in held:
+                try:
+                    self.get_collection().update_one(
+                        {"_id": name, "holder": holder}, {"$set": {"expires_at": expires_at}}
+                    )
+                except Exception as e:
+                    log.warning("lease %s not renewed: %s", name, e)
+
+
+class JobLeases:
+    # The coalescing and limits of a job queue, across processes. From
+    # submit until it starts a job holds its key's pending lease, so an
+    # identical trigger coalesces onto it whichever worker it reaches, and
+    # one of size queue slots. It starts once it gets its key's running
+    # lease, so two runs of one key never overlap, and one of workers run
+    # slots, which it holds until it finishes
+    def __init__(self, workers, size, store=None):
+        self.workers = workers
+        self.size = size
+        self.store = store or LeaseStore()
+        self.poll = float(os.getenv("JOB_LEASE_POLL", 1))
+        self.slots = dict()
+
+    def name(self, state, job):
+        return "|".join([state] + [str(part) for part in job.key])
+
+    def claim(self, job):
+        # the id of the job that waits for job's key, job's own if none did
+        holder = self.store.acquire(self.name("pending", job), job.id)
+        if holder != job.id:
+            return holder
+        slot = self.store.acquire_slot("queue", self.size, job.id)
+        if slot is None:
+            self.store.release(self.name("pending", job), job.id)
+            raise QueueFull(f"{self.size} jobs already pending")
+        self.slots[job.id] = slot
+        return job.id
+
+    def start(self, job):
+        # with the key's pending lease released here, the next trigger of
+        # the key queues a new job, which waits for this one to finish
+        if self.store.acquire(self.name("running", job), job.id) != job.id:
+            return False
+        slot = self.store.acquire_slot("run", self.workers, job.id)
+        if slot is None:
+            self.store.release(self.name("running", job), job.id)
+            return False
+        self.store.release(self.name("pending", job), job.id)
+        self.store.release(self.slots.pop(job.id), job.id)
+        self.slots[job.id] = slot
+        return True
+
+    def wait(self, job):
+        while True:
+            try:
+                if self.start(job):
+                    return
+            except Exception as e:
+                log.warning("job %s not started: %s", job.id, e)
+            sleep(self.poll)
+
+    def release(self, job):
+        # whatever job still holds, a lease taken over by another job is
+        # left alone
+        try:
+            self.store.release(self.name("pending", job), job.id)
+            self.store.release(self.name("running", job), job.id)
+            if job.id in self.slots:
+                self.store.release(self.slots.pop(job.id), job.id)
+        except Exception as e:
+            # the leases run out by themselves
+            log.warning("leases of job %s not released: %s", job.id, e)
@@ -0,0 +1,270 @@
+from threading import Lock, Thread
+from time import sleep, time
+import json
+import numpy
+import os
+
+# Process-wide counters and histograms in the Prometheus text format,
+# served by /metrics. With METRICS_DIR set, the gunicorn workers share
+# their values through it and any of them renders the totals.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = dict()
+        self.lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+    def merge(self, snapshots, live):
+        # snapshots: (worker, snapshot) pairs, the sum of every worker's
+        values = dict()
+        for _, snapshot in snapshots:
+            for key, value in snapshot:
+                key = tuple(key)
+                values[key] = values.get(key, 0) + value
+        return values
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        if values is None:
+            with self.lock:
+                values = dict(self.values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    # read when rendered, from a function returning {label values: value}
+    def __init__(self, name, description, labels, collect):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def snapshot(self):
+        return [[list(key), value] for key, value in self.collect().items()]
+
+    def merge(self, snapshots, live):
+        # a gauge isn't summed: each live worker's values, labelled with it
+        values = dict()
+        for worker, snapshot in snapshots:
+            if worker in live:
+                for key, value in snapshot:
+                    values[tuple(key) + (worker,)] = value
+        return values
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        labels = self.labels
+        if values is None:
+            values = self.collect()
+        else:
+            labels = labels + ("worker",)
+        for key, value in sorted(values.items()):
+            if value is not None:
+                lines.append(f"{self.name}{format_labels(labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = numpy.array(sorted(buckets), dtype=float)
+        # per label values: counts per bucket (non cumulative), sum, count
+        self.values = dict()
+        self.lock = Lock()
+
+    def observe(self, value, **labels):
+        self.observe_many([value], **labels)
+
+    def observe_many(self, values, **labels):
+        # a whole batch (one value per beacon) lands in one searchsorted
+        values = numpy.asarray(values, dtype=float)
+        values = values[numpy.isfinite(values)]
+        if len(values) == 0:
+            return
+        positions = numpy.searchsorted(self.buckets, values, side="left")
+        counts = numpy.bincount(positions, minlength=len(self.buckets) + 1)
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self.lock:
+            current = self.values.get(key)
+            if current is None:
+                current = self.values[key] = [numpy.zeros(len(self.buckets) + 1, dtype=numpy.int64), 0.0, 0]
+            current[0] += counts
+            current[1] += float(values.sum())
+            current[2] += len(values)
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(key), counts.tolist(), total, count] for key, (counts, total, count) in self.values.items()]
+
+    def merge(self, snapshots, live):
+        values = dict()
+        for _, snapshot in snapshots:
+            for key, counts, total, count in snapshot:
+                key = tuple(key)
+                current = values.get(key)
+                if current is None:
+                    current = values[key] = [numpy.zeros(len(self.buckets) + 1, dtype=numpy.int64), 0.0, 0]
+                current[0] += numpy.asarray(counts, dtype=numpy.int64)
+                current[1] += total
+                current[2] += count
+        return values
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ("le",)
+        if values is None:
+            with self.lock:
+                values = {key: (counts.copy(), total, count) for key, (counts, total, count) in self.values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = numpy.cumsum(counts)
+            for bound, value in zip(self.buckets.tolist() + ["+Inf"], cumulative.tolist()):
+                lines.append(f"{self.name}_bucket{format_labels(bucket_labels, key + (bound,))} {value}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    # With a directory, every process writes its values to
+    # <directory>/<parent pid>-<pid>.json each interval seconds, and render
+    # adds up the files of all the workers of one gunicorn master, so
+    # whichever worker answers a scrape the counters only go up. The file
+    # of a worker that exited stays in the totals; a worker whose file
+    # isn't rewritten for three intervals has its gauges left out
+    def __init__(self, directory=None, interval=5):
+        self.metrics = []
+        self.directory = directory
+        self.interval = interval
+        self.lock = Lock()
+        self.thread = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def start(self):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                # metrics never fail a worker, the next flush tries again
+                pass
+
+    def flush(self):
+        snapshot = {metric.name: metric.snapshot() for metric in self.metrics}
+        path = os.path.join(self.directory, f"{os.getppid()}-{os.getpid()}.json")
+        with self.lock:
+            with open(path + ".tmp", "w") as file:
+                json.dump(snapshot, file)
+            # a reader sees the previous file or this one, never half of it
+            os.replace(path + ".tmp", path)
+
+    def read(self):
+        snapshots, live = [], set()
+        prefix = f"{os.getppid()}-"
+        for name in os.listdir(self.directory):
+            if not name.startswith(prefix) or not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as file:
+                    snapshot = json.load(file)
+                modified = os.path.getmtime(path)
+            except (OSError, ValueError):
+                continue
+            worker = name[len(prefix) : -len(".json")]
+            snapshots.append((worker, snapshot))
+            if modified > time() - 3 * self.interval:
+                live.add(worker)
+        return snapshots, live
+
+    def render(self):
+        lines = []
+        if self.directory is None:
+            for metric in self.metrics:
+                lines.extend(metric.render())
+            return "\n".join(lines) + "\n"
+        self.flush()
+        snapshots, live = self.read()
+        for metric in self.metrics:
+            metric_snapshots = [(worker, snapshot.get(metric.name, [])) for worker, snapshot in snapshots]
+            lines.extend(metric.render(metric.merge(metric_snapshots, live)))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry(os.getenv("METRICS_DIR") or None, float(os.getenv("METRICS_FLUSH_SECONDS", 5)))
+
+
+def restart_registry():
+    # the flush thread doesn't survive a fork, a preloaded app starts it
+    # again in each worker
+    if registry.thread is not None:
+        registry.start()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=restart_registry)
+
+stage_seconds = registry.register(
+    Histogram("positions_stage_seconds", "Time spent in each processor stage", ["stage"])
+)
+stage_rows = registry.register(
+    Counter("positions_stage_rows_total", "Rows in and out of each processor stage", ["stage", "direction"])
+)
+jobs_total = registry.register(Counter("positions_jobs_total", "Finished jobs", ["processor", "state"]))
+job_seconds = registry.register(
+    Histogram("positions_job_seconds", "Run time of finished jobs", ["processor"])
+)
+beacon_lag_seconds = registry.register(
+    Histogram(
+        "positions_beacon_lag_seconds",
+        "Delay between a beacon's latest reading and its position being solved",
+        buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 21600, 86400),
+    )
+)
+http_requests = registry.register(
+    Counter("positions_http_requests_total", "Requests to the main API", ["method", "path", "status"])
+)
+mongo_commands = registry.register(
+    Counter("positions_mongo_commands_total", "Mongo commands", ["command", "status"])
+)
+mongo_seconds = registry.register(
+    Histogram("positions_mongo_command_seconds", "Mongo command round trips", ["command"])
+)
@@ -0,0 +1,57 @@
+from pymongo import MongoClient, monitoring
+from threading import Lock
+import os
+
+from src.modules.metrics import mongo_commands, mongo_seconds
+
+client = None
+client_pid = None
+lock = Lock()
+
+
+class CommandMetrics(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_commands.inc(command=event.command_name, status="ok")
+        mongo_seconds.observe(event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        mongo_commands.inc(command=event.command_name, status="error")
+        mongo_seconds.observe(event.duration_micros / 1e6, command=event.command_name)
+
+
+def create_client():
+    return MongoClient(
+        os.getenv("MONGO_DB"),
+        maxPoolSize=int(os.getenv("MONGO_POOL_SIZE", 20)),
+        connectTimeoutMS=int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 10000)),
+        serverSelectionTimeoutMS=int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000)),
+        socketTimeoutMS=int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 60000)),
+        # nothing connects until the first operation, so a client created
+        # before gunicorn forks never shares sockets with the workers
+        connect=False,
+        event_listeners=[CommandMetrics()],
+    )
+
+
+def get_client():
+    # one client (and connection pool) per process; a client inherited
+    # through fork is never reused by the child
+    global client, client_pid
+    with lock:
+        if client is None or client_pid != os.getpid():
+            client = create_client()
+            client_pid = os.getpid()
+        return client
+
+
+def reset_client():
+    global client, client_pid
+    client = None
+    client_pid = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_client)
@@ -0,0 +1,144 @@
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from threading import Lock, Thread
+import asyncio
+import logging
+import os
+import sys
+
+from src.modules.jobs import Job, QueueFull
+
+log = logging.getLogger(__name__)
+
+
+class NativeThreadPool(Executor):
+    # Under gunicorn -k gevent the threading module is patched and a
+    # ThreadPoolExecutor's threads are greenlets on the worker's hub, so
+    # pandas would block the hub just the same. This runs calls on gevent's
+    # pool of real OS threads and settles standard futures from the hub,
+    # which is what run_in_executor expects
+    def __init__(self, workers):
+        from gevent.threadpool import ThreadPool
+
+        self.pool = ThreadPool(workers)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+
+        def settle(result):
+            if result.successful():
+                future.set_result(result.value)
+            else:
+                future.set_exception(result.exception)
+
+        self.pool.spawn(fn, *args, **kwargs).rawlink(settle)
+        return future
+
+    def shutdown(self, wait=True):
+        self.pool.kill()
+
+
+def cpu_thread_pool(workers):
+    if "gevent" in sys.modules:
+        from gevent import monkey
+
+        if monkey.is_module_patched("threading"):
+            return NativeThreadPool(workers)
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+class AsyncJobQueue:
+    # Same interface as JobQueue, with the jobs scheduled on one asyncio
+    # loop running in a background thread. Blocking Mongo and HTTP calls go
+    # to the I/O executor and pandas/NumPy stages to the CPU executor, so a
+    # run can read its next chunk while the current one is being solved and
+    # request handlers never wait on a job. Under gevent the I/O executor's
+    # threads are greenlets, so blocking requests and pymongo calls already
+    # yield to the hub there
+    def __init__(self, workers=2, size=16, history=1000, leases=None, store=None):
+        self.workers = workers
+        self.size = size
+        self.pending = dict()
+        self.leases = leases
+        self.history = history
+        self.store = store
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+        self.loop = None
+        self.semaphore = None
+        self.io_executor = None
+        self.cpu_executor = None
+
+    def start(self):
+        # the loop starts on the first submit so nothing runs before gunicorn forks
+        if self.loop is not None:
+            return
+        self.io_executor = ThreadPoolExecutor(max_workers=int(os.getenv("JOB_IO_WORKERS", 8)))
+        self.cpu_executor = cpu_thread_pool(int(os.getenv("JOB_CPU_WORKERS", self.workers)))
+        self.loop = asyncio.new_event_loop()
+        ready = Lock()
+        ready.acquire()
+        thread = Thread(target=self.run_loop, args=(ready,))
+        thread.daemon = True
+        thread.start()
+        ready.acquire()
+
+    def run_loop(self, ready):
+        asyncio.set_event_loop(self.loop)
+        # at most workers jobs run at once, the others wait on the loop
+        self.semaphore = asyncio.Semaphore(self.workers)
+        ready.release()
+        self.loop.run_forever()
+
+    def submit(self, class_name, params=None, profile=False):
+        job = Job(class_name, params, profile, history=self.store)
+        with self.lock:
+            self.start()
+            pending = self.pending.get(job.key)
+            if pending is not None:
+                return pending.id
+            if len(self.pending) >= self.size:
+                raise QueueFull(f"{self.size} jobs already pending")
+            if self.leases is not None:
+                holder = self.leases.claim(job)
+                if holder != job.id:
+                    return holder
+            job.save()
+            self.pending[job.key] = job
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.history:
+                self.jobs.popitem(last=False)
+        asyncio.run_coroutine_threadsafe(self.execute(job), self.loop)
+        return job.id
+
+    async def execute(self, job):
+        loop = asyncio.get_event_loop()
+        async with self.semaphore:
+            if self.leases is not None:
+                while True:
+                    try:
+                        if await loop.run_in_executor(self.io_executor, self.leases.start, job):
+                            break
+                    except Exception as e:
+                        log.warning("job %s not started: %s", job.id, e)
+                    await asyncio.sleep(self.leases.poll)
+            with self.lock:
+                self.pending.pop(job.key, None)
+            log.info("start %s", job.id)
+            try:
+                await job.run_async(self.io_executor, self.cpu_executor)
+            except Exception as e:
+                log.error("job %s failed: %s", job.id, e)
+            finally:
+                if self.leases is not None:
+                    await loop.run_in_executor(self.io_executor, self.leases.release, job)
+            log.info("done %s", job.id)
+
+    def find(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            return job.to_record()
+        if self.store is not None:
+            return self.store.find(job_id)
+        return None
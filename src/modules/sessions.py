@@ -0,0 +1,44 @@
+from datetime import datetime
+from pymongo import ASCENDING, ReplaceOne
+import os
+
+
+class SessionStore:
+    # Open dwell sessions by (beacon, area), kept between runs. A session
+    # is the segment still open at the end of a run: when it started
+    # (first), its last position (current) and the position that opened it
+    def __init__(self, client):
+        self.collection = client["beacons"]["dwell_sessions"]
+        self.ttl = int(os.getenv("DWELL_SESSION_TTL", 86400))
+        self.indexed = False
+
+    def key(self, beacon, area):
+        return f"{beacon}|{area}"
+
+    def load(self, keys):
+        # keys: (beacon, area) pairs seen in this run
+        ids = [self.key(beacon, area) for beacon, area in keys]
+        sessions = dict()
+        if len(ids) == 0:
+            return sessions
+        for document in self.collection.find({"_id": {"$in": ids}}):
+            sessions[(document.get("beacon"), document.get("area"))] = document
+        return sessions
+
+    def save(self, sessions):
+        if len(sessions) == 0:
+            return
+        if not self.indexed:
+            # sessions nobody extends for a day are dropped by Mongo
+            self.collection.create_index([("updated_at", ASCENDING)], expireAfterSeconds=self.ttl)
+            self.indexed = True
+        updated_at = datetime.utcnow()
+        operations = [
+            ReplaceOne(
+                {"_id": self.key(beacon, area)},
+                dict(session, beacon=beacon, area=area, updated_at=updated_at),
+                upsert=True,
+            )
+            for (beacon, area), session in sessions.items()
+        ]
+        self.collection.bulk_write(operations, ordered=False)
@@ -0,0 +1,158 @@
+from datetime import datetime
+from pymongo import ASCENDING, ReplaceOne
+import numpy
+import os
+import pandas as pd
+
+FIELDS = ["t", "px", "py", "vx", "vy", "p00", "p01", "p11"]
+
+
+class TrackStore:
+    # Smoother state per beacon, kept between runs so a track continues
+    # where the previous run left it instead of restarting from a raw fix
+    def __init__(self, client):
+        self.collection = client["beacons"]["track_state"]
+        self.ttl = int(os.getenv("SMOOTHING_STATE_TTL", 86400))
+        self.indexed = False
+
+    def load(self, beacons):
+        states = dict()
+        if len(beacons) == 0:
+            return states
+        for document in self.collection.find({"_id": {"$in": list(beacons)}}):
+            states[document["_id"]] = {field: document.get(field) for field in FIELDS}
+        return states
+
+    def save(self, states):
+        if len(states) == 0:
+            return
+        if not self.indexed:
+            self.collection.create_index([("updated_at", ASCENDING)], expireAfterSeconds=self.ttl)
+            self.indexed = True
+        updated_at = datetime.utcnow()
+        operations = [
+            ReplaceOne({"_id": beacon}, dict(state, updated_at=updated_at), upsert=True)
+            for beacon, state in states.items()
+        ]
+        self.collection.bulk_write(operations, ordered=False)
+
+
+class TrackSmoother:
+    # Smooths trilaterated tracks, "ema" with an exponential moving average
+    # whose weight follows the time between fixes, "kalman" with a
+    # constant-velocity Kalman filter per axis. Both recurrences are
+    # sequential within a track, so they step through the k-th fix of every
+    # beacon at once. A gap over reset_after seconds restarts the track
+    def __init__(self, method="ema", tau=None, process_noise=None, measurement_noise=None, reset_after=None):
+        self.method = method
+        self.tau = float(tau or os.getenv("SMOOTHING_TAU", 5.0))
+        self.process_noise = float(process_noise or os.getenv("SMOOTHING_PROCESS_NOISE", 0.05))
+        self.measurement_noise = float(measurement_noise or os.getenv("SMOOTHING_MEASUREMENT_NOISE", 1.0))
+        self.reset_after = float(reset_after or os.getenv("SMOOTHING_RESET_AFTER", 60))
+        # variance of the speed of a fresh track, in (m/s)^2
+        self.initial_speed = 1.0
+
+    def smooth(self, beacons, times, x, y, states, resume=True):
+        # beacons, times (seconds), x and y are arrays of one fix per row,
+        # states the stored state of each beacon. With resume, fixes at or
+        # behind a beacon's stored state were smoothed by the run that
+        # stored it (an incremental run starts a grace period behind its
+        # watermark): they're skipped and the track resumes from the state.
+        # Without it (a backfill) a stored state only continues a track that
+        # starts after it, any other track starts over. Returns the smoothed
+        # x and y in the same row order, a mask of the rows smoothed and the
+        # state after each beacon's last fix
+        smoothed_x = numpy.array(x, dtype=float)
+        smoothed_y = numpy.array(y, dtype=float)
+        times = numpy.asarray(times, dtype=float)
+        if len(beacons) == 0:
+            return smoothed_x, smoothed_y, numpy.zeros(0, dtype=bool), dict()
+        codes, names = pd.factorize(pd.Series(beacons, dtype=object))
+        names = names.tolist()
+        state = {field: numpy.full(len(names), numpy.nan) for field in FIELDS}
+        for code, name in enumerate(names):
+            stored = states.get(name)
+            if stored is not None and stored.get("t") is not None:
+                for field in FIELDS:
+                    state[field][code] = stored[field]
+        if resume:
+            kept = ~(times <= state["t"][codes])
+        else:
+            kept = numpy.ones(len(codes), dtype=bool)
+            first_times = numpy.full(len(names), numpy.inf)
+            numpy.minimum.at(first_times, codes, times)
+            for field in FIELDS:
+                state[field][~(state["t"] < first_times)] = numpy.nan
+
+        order = numpy.flatnonzero(kept)
+        order = order[numpy.lexsort((times[order], codes[order]))]
+        codes, times = codes[order], times[order]
+        measured_x, measured_y = smoothed_x[order], smoothed_y[order]
+        starts = numpy.r_[True, codes[1:] != codes[:-1]] if len(codes) > 0 else numpy.zeros(0, dtype=bool)
+        first = numpy.flatnonzero(starts)
+        ranks = numpy.arange(len(codes)) - numpy.repeat(first, numpy.diff(numpy.r_[first, len(codes)]))
+
+        out_x = numpy.empty(len(codes))
+        out_y = numpy.empty(len(codes))
+        by_rank = numpy.argsort(ranks, kind="stable")
+        bounds = numpy.r_[0, numpy.cumsum(numpy.bincount(ranks))]
+        for rank in range(len(bounds) - 1):
+            rows = by_rank[bounds[rank] : bounds[rank + 1]]
+            tracks = codes[rows]
+            current = {field: values[tracks] for field, values in state.items()}
+            dt = times[rows] - current["t"]
+            fresh = ~(dt <= self.reset_after)
+            dt = numpy.where(fresh, 0.0, dt)
+            if self.method == "kalman":
+                self.kalman_step(current, dt, fresh, measured_x[rows], measured_y[rows])
+            else:
+                self.ema_step(current, dt, fresh, measured_x[rows], measured_y[rows])
+            current["t"] = times[rows]
+            for field, values in current.items():
+                state[field][tracks] = values
+            out_x[rows] = current["px"]
+            out_y[rows] = current["py"]
+
+        smoothed_x[order] = out_x
+        smoothed_y[order] = out_y
+        final = {
+            name: {field: float(state[field][code]) for field in FIELDS}
+            for code, name in enumerate(names)
+            if not numpy.isnan(state["t"][code])
+        }
+        return smoothed_x, smoothed_y, kept, final
+
+    def ema_step(self, state, dt, fresh, x, y):
+        weight = numpy.where(fresh, 1.0, 1 - numpy.exp(-dt / self.tau))
+        state["px"] = numpy.where(fresh, x, state["px"] + weight * (x - state["px"]))
+        state["py"] = numpy.where(fresh, y, state["py"] + weight * (y - state["py"]))
+        for field in ("vx", "vy", "p00", "p01", "p11"):
+            state[field] = numpy.zeros(len(dt))
+
+    def kalman_step(self, state, dt, fresh, x, y):
+        # x and y share the model and the noise, so they share the covariance
+        q, r = self.process_noise, self.measurement_noise
+        for field, value in (("vx", 0.0), ("vy", 0.0), ("p00", r), ("p01", 0.0), ("p11", self.initial_speed)):
+            state[field] = numpy.where(fresh, value, state[field])
+        state["px"] = numpy.where(fresh, x, state["px"] + dt * state["vx"])
+        state["py"] = numpy.where(fresh, y, state["py"] + dt * state["vy"])
+        p00, p01, p11 = state["p00"], state["p01"], state["p11"]
+        p00 = p00 + 2 * dt * p01 + dt ** 2 * p11 + q * dt ** 3 / 3
+        p01 = p01 + dt * p11 + q * dt ** 2 / 2
+        p11 = p11 + q * dt
+
+        gain_position = p00 / (p00 + r)
+        gain_speed = p01 / (p00 + r)
+        # a fresh track is its measurement, with no correction on top
+        gain_position = numpy.where(fresh, 0.0, gain_position)
+        gain_speed = numpy.where(fresh, 0.0, gain_speed)
+        error_x = x - state["px"]
+        error_y = y - state["py"]
+        state["px"] = state["px"] + gain_position * error_x
+        state["py"] = state["py"] + gain_position * error_y
+        state["vx"] = state["vx"] + gain_speed * error_x
+        state["vy"] = state["vy"] + gain_speed * error_y
+        state["p11"] = p11 - gain_speed * p01
+        state["p01"] = (1 - gain_position) * p01
+        state["p00"] = (1 - gain_position) * p00
+
@@ -0,0 +1,226 @@
+from collections import OrderedDict
+from hashlib import sha1
+from math import ceil, floor, sqrt
+from threading import Lock
+import json
+import numpy
+import os
+
+
+class AreaIndex:
+    # Uniform grid over the bounding boxes of a facility's areas. Each cell
+    # lists the areas whose box overlaps it, in the facility's order, so the
+    # exact point-in-polygon test only runs on areas that can contain the
+    # point and the first match is still the first area in the list
+    def __init__(self, areas, cell_size=None):
+        self.areas = [area for area in areas if len(area.get("vertices") or []) >= 3]
+        self.fingerprint = sha1(
+            json.dumps(
+                [[area.get("idArea"), area.get("vertices")] for area in self.areas], default=str
+            ).encode()
+        ).hexdigest()
+        self.boxes = []
+        for area in self.areas:
+            xs = [float(vertex[0]) for vertex in area.get("vertices")]
+            ys = [float(vertex[1]) for vertex in area.get("vertices")]
+            self.boxes.append((min(xs), min(ys), max(xs), max(ys)))
+        self.cells = dict()
+        if len(self.boxes) == 0:
+            return
+
+        self.min_x = min(box[0] for box in self.boxes)
+        self.min_y = min(box[1] for box in self.boxes)
+        width = max(box[2] for box in self.boxes) - self.min_x
+        height = max(box[3] for box in self.boxes) - self.min_y
+        if cell_size is None:
+            # about one cell per area along each side of the facility
+            cell_size = max(width, height) / ceil(sqrt(len(self.boxes)))
+        self.cell_size = cell_size if cell_size > 0 else 1.0
+
+        for position, (min_x, min_y, max_x, max_y) in enumerate(self.boxes):
+            first_x, first_y = self.cell(min_x, min_y)
+            last_x, last_y = self.cell(max_x, max_y)
+            for cell_x in range(first_x, last_x + 1):
+                for cell_y in range(first_y, last_y + 1):
+                    self.cells.setdefault((cell_x, cell_y), []).append(position)
+
+        # the same grid as flat arrays for batches of points: cell_areas
+        # holds the areas of cell c at cell_start[c]:cell_start[c + 1]
+        self.shape = self.cell(self.min_x + width, self.min_y + height)
+        self.shape = (self.shape[0] + 1, self.shape[1] + 1)
+        sizes = numpy.zeros(self.shape[0] * self.shape[1], dtype=int)
+        for (cell_x, cell_y), positions in self.cells.items():
+            sizes[cell_x * self.shape[1] + cell_y] = len(positions)
+        self.cell_start = numpy.concatenate([[0], numpy.cumsum(sizes)])
+        self.cell_areas = numpy.zeros(self.cell_start[-1], dtype=int)
+        for (cell_x, cell_y), positions in self.cells.items():
+            start = self.cell_start[cell_x * self.shape[1] + cell_y]
+            self.cell_areas[start : start + len(positions)] = positions
+        self.box_array = numpy.array(self.boxes, dtype=float)
+
+        # vertices padded to the largest area, with the real vertex counts
+        self.counts = numpy.array([len(area.get("vertices")) for area in self.areas])
+        self.vertices = numpy.zeros((len(self.areas), self.counts.max(), 2))
+        for position, area in enumerate(self.areas):
+            self.vertices[position, : self.counts[position]] = numpy.asarray(
+                area.get("vertices"), dtype=float
+            )[:, :2]
+
+    def __len__(self):
+        return len(self.areas)
+
+    def cell(self, x, y):
+        return (
+            floor((x - self.min_x) / self.cell_size),
+            floor((y - self.min_y) / self.cell_size),
+        )
+
+    def candidates(self, point):
+        if len(self.cells) == 0:
+            return []
+        x, y = point
+        output = []
+        for position in self.cells.get(self.cell(x, y), []):
+            min_x, min_y, max_x, max_y = self.boxes[position]
+            if min_x <= x <= max_x and min_y <= y <= max_y:
+                output.append(self.areas[position])
+        return output
+
+    def pairs(self, points):
+        # (point, area) candidate pairs for an (N, 2) array of points, ordered
+        # by point and then by area position
+        empty = numpy.zeros(0, dtype=int)
+        if len(self.cells) == 0 or len(points) == 0:
+            return empty, empty
+        cell_x = numpy.floor((points[:, 0] - self.min_x) / self.cell_size)
+        cell_y = numpy.floor((points[:, 1] - self.min_y) / self.cell_size)
+        on_grid = (
+            (cell_x >= 0) & (cell_x < self.shape[0]) & (cell_y >= 0) & (cell_y < self.shape[1])
+        )
+        on_grid &= numpy.isfinite(points).all(axis=1)
+        cells = numpy.zeros(len(points), dtype=int)
+        cells[on_grid] = (cell_x[on_grid] * self.shape[1] + cell_y[on_grid]).astype(int)
+        sizes = numpy.where(on_grid, self.cell_start[cells + 1] - self.cell_start[cells], 0)
+
+        point_index = numpy.repeat(numpy.arange(len(points)), sizes)
+        offsets = numpy.arange(len(point_index)) - numpy.repeat(numpy.cumsum(sizes) - sizes, sizes)
+        area_index = self.cell_areas[self.cell_start[cells[point_index]] + offsets]
+
+        boxes = self.box_array[area_index]
+        x, y = points[point_index, 0], points[point_index, 1]
+        in_box = (x >= boxes[:, 0]) & (x <= boxes[:, 2]) & (y >= boxes[:, 1]) & (y <= boxes[:, 3])
+        return point_index[in_box], area_index[in_box]
+
+
+class AreaRaster:
+    # A facility's areas compiled into a label grid of resolution-sized
+    # cells: the position of the first area containing the cell, NONE for
+    # no area, or EXACT for cells an edge crosses, where the answer can
+    # change inside the cell. Only points in EXACT cells, and points at the
+    # height of a vertex (whose ray can pass through it), need the polygon
+    # test
+    NONE = -1
+    EXACT = -2
+
+    def __init__(self, index, inside, resolution=0.25, max_cells=4000000):
+        self.labels = numpy.full((0, 0), self.NONE, dtype=numpy.int32)
+        if len(index) == 0:
+            return
+        self.min_x, self.min_y = index.min_x, index.min_y
+        width = index.box_array[:, 2].max() - self.min_x
+        height = index.box_array[:, 3].max() - self.min_y
+        while (width / resolution + 1) * (height / resolution + 1) > max_cells:
+            resolution *= 2
+        self.resolution = resolution
+        self.shape = (int(width // resolution) + 1, int(height // resolution) + 1)
+
+        exact = numpy.zeros(self.shape, dtype=bool)
+        # a little slack so rounding in the samples can't miss a cell
+        slack = 1e-9 * max(width, height, 1.0)
+        for vertices, count in zip(index.vertices, index.counts):
+            vertices = vertices[:count]
+            for start, end in zip(vertices, numpy.roll(vertices, -1, axis=0)):
+                # samples less than a cell apart move at most one cell per
+                # axis, so the cells crossed between two samples are theirs
+                # and the two mixed ones
+                steps = int(numpy.hypot(*(end - start)) / (resolution / 2)) + 2
+                samples = start + numpy.linspace(0, 1, steps)[:, None] * (end - start)
+                for offset_x in (-slack, slack):
+                    for offset_y in (-slack, slack):
+                        cells_x, cells_y = self.cells(samples + [offset_x, offset_y])
+                        exact[cells_x, cells_y] = True
+                        exact[cells_x[1:], cells_y[:-1]] = True
+                        exact[cells_x[:-1], cells_y[1:]] = True
+        # rays through a vertex are decided by the exact test, see lookup
+        self.vertex_ys = numpy.unique(
+            numpy.concatenate(
+                [vertices[:count, 1] for vertices, count in zip(index.vertices, index.counts)]
+            )
+        )
+
+        self.labels = numpy.full(self.shape, self.NONE, dtype=numpy.int32)
+        self.labels[exact] = self.EXACT
+        cells_x, cells_y = numpy.nonzero(~exact)
+        centers = numpy.column_stack(
+            [
+                self.min_x + (cells_x + 0.5) * resolution,
+                self.min_y + (cells_y + 0.5) * resolution,
+            ]
+        )
+        point_index, area_index = index.pairs(centers)
+        matched = inside(index.vertices[area_index], index.counts[area_index], centers[point_index])
+        first_points, first = numpy.unique(point_index[matched], return_index=True)
+        self.labels[cells_x[first_points], cells_y[first_points]] = area_index[matched][first]
+
+    def cells(self, points):
+        cells_x = numpy.floor((points[:, 0] - self.min_x) / self.resolution).astype(int)
+        cells_y = numpy.floor((points[:, 1] - self.min_y) / self.resolution).astype(int)
+        return (
+            numpy.clip(cells_x, 0, self.shape[0] - 1),
+            numpy.clip(cells_y, 0, self.shape[1] - 1),
+        )
+
+    def lookup(self, points):
+        # label of each point of an (N, 2) array, NONE off the grid
+        labels = numpy.full(len(points), self.NONE, dtype=numpy.int32)
+        if self.labels.size == 0 or len(points) == 0:
+            return labels
+        cell_x = numpy.floor((points[:, 0] - self.min_x) / self.resolution)
+        cell_y = numpy.floor((points[:, 1] - self.min_y) / self.resolution)
+        on_grid = (
+            (cell_x >= 0) & (cell_x < self.shape[0]) & (cell_y >= 0) & (cell_y < self.shape[1])
+        )
+        labels[on_grid] = self.labels[cell_x[on_grid].astype(int), cell_y[on_grid].astype(int)]
+        labels[on_grid & numpy.isin(points[:, 1], self.vertex_ys)] = self.EXACT
+        return labels
+
+
+class RasterCache:
+    # compiled rasters keyed by a fingerprint of the facility's areas, so a
+    # refetch with the same vertices reuses the raster and changed vertices
+    # compile a new one
+    def __init__(self, size=64):
+        self.size = size
+        self.rasters = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, index, inside, resolution, max_cells):
+        key = (index.fingerprint, resolution, max_cells)
+        with self.lock:
+            raster = self.rasters.get(key)
+            if raster is not None:
+                self.rasters.move_to_end(key)
+                return raster
+        raster = AreaRaster(index, inside, resolution=resolution, max_cells=max_cells)
+        with self.lock:
+            self.rasters[key] = raster
+            while len(self.rasters) > self.size:
+                self.rasters.popitem(last=False)
+        return raster
+
+    def clear(self):
+        with self.lock:
+            self.rasters.clear()
+
+
+raster_cache = RasterCache(size=int(os.getenv("AREA_RASTER_CACHE_SIZE", 64)))
@@ -0,0 +1,54 @@
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+from src.modules.metrics import stage_rows, stage_seconds
+
+
+class Stage:
+    def __init__(self):
+        self.seconds = 0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.calls = 0
+
+    def to_dict(self):
+        return {
+            "seconds": round(self.seconds, 6),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "calls": self.calls,
+        }
+
+
+class Stats:
+    def __init__(self, listener=None):
+        self.stages = dict()
+        self.lock = Lock()
+        # called with no arguments whenever a stage ends
+        self.listener = listener
+
+    @contextmanager
+    def stage(self, name):
+        # a stage entered more than once (per chunk, per processor) accumulates
+        current = Stage()
+        start = perf_counter()
+        try:
+            yield current
+        finally:
+            current.seconds = perf_counter() - start
+            with self.lock:
+                total = self.stages.setdefault(name, Stage())
+                total.seconds += current.seconds
+                total.rows_in += current.rows_in
+                total.rows_out += current.rows_out
+                total.calls += 1
+            stage_seconds.observe(current.seconds, stage=name)
+            stage_rows.inc(current.rows_in, stage=name, direction="in")
+            stage_rows.inc(current.rows_out, stage=name, direction="out")
+            if self.listener is not None:
+                self.listener()
+
+    def to_dict(self):
+        with self.lock:
+            return {name: stage.to_dict() for name, stage in self.stages.items()}
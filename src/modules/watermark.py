@@ -0,0 +1,34 @@
+from datetime import datetime, timedelta
+import os
+
+
+class Watermark:
+    def __init__(self, client, name):
+        self.name = name
+        self.collection = client["beacons"]["watermarks"]
+        # rows that arrive late, with a created_at just behind the mark, are
+        # picked up by starting every incremental run this far back
+        self.grace = timedelta(seconds=float(os.getenv("WATERMARK_GRACE_SECONDS", 60)))
+
+    def get(self):
+        document = self.collection.find_one({"_id": self.name})
+        if document is None:
+            return None
+        return document.get("created_at")
+
+    def resolve(self, timestamp=None):
+        # an explicit timestamp (backfill) wins over the stored mark
+        if timestamp is not None:
+            return datetime.fromisoformat(str(timestamp))
+        last = self.get()
+        if last is None:
+            raise ValueError(f"no {self.name} watermark yet, a timestamp is required")
+        return last - self.grace
+
+    def commit(self, created_at):
+        # $max keeps a backfill over an old window from moving the mark back
+        self.collection.update_one(
+            {"_id": self.name},
+            {"$max": {"created_at": created_at}, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True,
+        )
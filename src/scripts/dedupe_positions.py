@@ -0,0 +1,74 @@
+from pymongo import ASCENDING, DeleteMany
+from dotenv import load_dotenv
+import argparse
+import logging
+
+from src.modules.mongo import get_client
+
+# Runs from before the upserts inserted every position again on each
+# trigger, so beacons_data can hold one (beacon, created_at) several times
+# and the unique index the processor wants can't be built. This keeps one
+# document per key, deletes the rest and swaps the plain index the
+# processor falls back to for the unique one. Run it once, off hours:
+#
+#   python -m src.scripts.dedupe_positions --dry-run
+#   python -m src.scripts.dedupe_positions
+
+log = logging.getLogger(__name__)
+
+KEYS = [("beacon", ASCENDING), ("created_at", ASCENDING)]
+
+
+def find_duplicates(collection):
+    # the _ids of every copy but the first of each duplicated key
+    cursor = collection.aggregate(
+        [
+            {"$group": {"_id": {"beacon": "$beacon", "created_at": "$created_at"}, "ids": {"$push": "$_id"}}},
+            {"$match": {"ids.1": {"$exists": True}}},
+        ],
+        allowDiskUse=True,
+    )
+    for group in cursor:
+        for document_id in group["ids"][1:]:
+            yield document_id
+
+
+def delete_duplicates(collection, batch_size):
+    deleted = 0
+    batch = []
+    for document_id in find_duplicates(collection):
+        batch.append(document_id)
+        if len(batch) >= batch_size:
+            deleted += collection.bulk_write([DeleteMany({"_id": {"$in": batch}})]).deleted_count
+            batch = []
+    if len(batch) > 0:
+        deleted += collection.bulk_write([DeleteMany({"_id": {"$in": batch}})]).deleted_count
+    return deleted
+
+
+def create_unique_index(collection):
+    for name, index in collection.index_information().items():
+        if index["key"] == KEYS:
+            if index.get("unique"):
+                return name
+            collection.drop_index(name)
+    return collection.create_index(KEYS, unique=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Remove duplicated positions and build their unique index")
+    parser.add_argument("--dry-run", action="store_true", help="only count the duplicates")
+    parser.add_argument("--batch-size", type=int, default=1000, help="documents deleted per request")
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO")
+    load_dotenv()
+    collection = get_client()["beacons"]["beacons_data"]
+    if args.dry_run:
+        log.info("%d duplicated positions", sum(1 for _ in find_duplicates(collection)))
+        return
+    log.info("%d duplicated positions deleted", delete_duplicates(collection, args.batch_size))
+    log.info("unique index %s ready", create_unique_index(collection))
+
+
+if __name__ == "__main__":
+    main()